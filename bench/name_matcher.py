@@ -0,0 +1,73 @@
+"""
+Benchmarks NameMatcher against the per-name, per-prefix re.search the
+namespace GC used to do, over a synthetic inventory of namespaces, helm
+releases and vms.
+
+    python bench/name_matcher.py [names] [prefixes]
+"""
+import random
+import re
+import sys
+import time
+
+from circleci.namespace_gc import NameMatcher
+
+
+def synthetic_names(count, prefixes):
+    random.seed(0)
+    names = []
+    for i in range(count):
+        prefix = random.choice(prefixes)
+        build_num = random.randint(1, 99999)
+        kind = i % 4
+        if kind == 0:
+            names.append(('namespace', '{}-{}'.format(prefix, build_num)))
+        elif kind == 1:
+            names.append(('release', 'service-{}-{}-{}'.format(i % 7, prefix, build_num)))
+        elif kind == 2:
+            names.append(('vm', 'condor-{}-{}'.format(prefix, build_num)))
+        else:
+            names.append(('release', 'cron-{}-kube-system'.format(i)))
+    return names
+
+
+def old_classify(kind, name, prefixes):
+    for prefix in prefixes:
+        if kind == 'namespace':
+            match = re.search('^{}-(\\d+)$'.format(prefix), name)
+        elif kind == 'release':
+            match = re.search('^\\S*-{}-(\\d+)$'.format(prefix), name)
+        else:
+            if name.startswith('condor-{}-'.format(prefix)):
+                return prefix, name.strip('condor-{}-'.format(prefix))
+            continue
+        if match:
+            return prefix, match.group(1)
+    return None, None
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    prefix_count = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    prefixes = ['team{}-ci'.format(i) for i in range(prefix_count)]
+    names = synthetic_names(count, prefixes)
+
+    start = time.time()
+    old = [old_classify(kind, name, prefixes) for kind, name in names]
+    old_time = time.time() - start
+
+    start = time.time()
+    matcher = NameMatcher(prefixes)
+    match = {'namespace': matcher.namespace, 'release': matcher.release, 'vm': matcher.vm}
+    new = [match[kind](name) for kind, name in names]
+    new_time = time.time() - start
+
+    # the old vm match used str.strip and mangled build numbers such as 39882
+    differ = sum(1 for a, b in zip(old, new) if a != b)
+    print('{} names, {} prefixes, {} classified differently'.format(count, prefix_count, differ))
+    print('re.search per prefix: {:.3f}s'.format(old_time))
+    print('NameMatcher:          {:.3f}s ({:.1f}x)'.format(new_time, old_time / new_time))
+
+
+if __name__ == '__main__':
+    main()
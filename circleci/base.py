@@ -1,7 +1,14 @@
 import os
-import requests
+from multiprocessing.pool import ThreadPool
 from requests.auth import HTTPBasicAuth
 from github import GithubStatus
+from circleci.parallel import AsyncClient
+from circleci.scheduler import get_scheduler
+from circleci.session import get_session
+
+# builds every page shares with the previous one, so builds that move back a
+# page when newer ones finish while paging are still seen
+PAGE_OVERLAP = 10
 
 
 class CircleCIBase():
@@ -10,17 +17,22 @@ class CircleCIBase():
         token = os.environ.get('CIRCLE_TOKEN')
         if token is None:
             raise Exception("Must set env var CIRCLE_TOKEN")
+        self.token = token
         self.auth = HTTPBasicAuth(token, '')
         self.github_url = 'https://circleci.com/api/v1.1/project/github'
+        self.session = get_session()
+        self.scheduler = get_scheduler()
 
     def request(self, verb, url, data=None):
         headers = {
             'Content-Type': 'application/json'
         }
         if verb == 'get':
-            resp = requests.get(url, auth=self.auth, headers=headers)
+            resp = self.scheduler.send(
+                self.token, verb, self.session.get, url, auth=self.auth, headers=headers)
         elif verb == 'post':
-            resp = requests.post(url, auth=self.auth, headers=headers, data=data)
+            resp = self.scheduler.send(
+                self.token, verb, self.session.post, url, auth=self.auth, headers=headers, data=data)
 
         if 200 <= resp.status_code < 300:
             return resp.json()
@@ -35,14 +47,59 @@ class CircleCIBase():
         return self.request('post', url, data=data)
 
     # get running builds
-    def get_build_status(self, repo, branch=None, filter='running', limit=30):
+    def get_build_status(self, repo, branch=None, filter='running', limit=30, offset=0):
         # GET: /project/:vcs-type/:username/:project
         if branch is not None:
             repo = "{}/tree/{}".format(repo, branch)
-        url = '{}/{}?filter={}&limit={}'.\
-            format(self.github_url, repo, filter, limit)
+        url = '{}/{}?filter={}&limit={}&offset={}'.\
+            format(self.github_url, repo, filter, limit, offset)
         return self.get(url)
 
+    def iter_builds(self, repo, branch=None, filter='running', page_size=100,
+                    overlap=PAGE_OVERLAP):
+        """
+        Yields every build matching filter, newest first, paging through the
+        project builds endpoint. The next page is fetched in the background
+        while the current one is consumed, and only one page is held at a
+        time.
+
+        The list shifts while it is paged: builds that start push older ones
+        onto the next page and builds that finish pull them back onto the
+        previous one. Pages overlap by overlap builds and are deduplicated on
+        build number, so every build is yielded once as long as fewer than
+        overlap builds finish between two page fetches.
+
+        Args:
+        repo (string): github org/repo
+        branch (string): only list builds for this branch
+        filter (string): completed, successful, failed, running or None
+        page_size (int): builds per request, circleci allows at most 100
+        overlap (int): builds shared by consecutive pages
+        """
+        step = page_size - min(overlap, page_size // 2)
+        pool = ThreadPool(1)
+        seen = set()
+        try:
+            offset = 0
+            page = pool.apply_async(
+                self.get_build_status, (repo, branch, filter, page_size, offset))
+            while page is not None:
+                builds = page.get()
+                if not isinstance(builds, list):
+                    raise ValueError("Unexpected type for data: {}".format(builds))
+                page = None
+                if len(builds) == page_size:
+                    offset += step
+                    page = pool.apply_async(
+                        self.get_build_status, (repo, branch, filter, page_size, offset))
+                for build in builds:
+                    if build['build_num'] in seen:
+                        continue
+                    seen.add(build['build_num'])
+                    yield build
+        finally:
+            pool.terminate()
+
     def get_single_build_status(self, repo, build_num):
         # GET: /project/:vcs-type/:username/:project/:build_num
         url = '{}/{}/{}'.\
@@ -56,11 +113,20 @@ class CircleCIBase():
         url = '{}/{}/tree/{}'.\
             format(self.github_url, repo, branch)
         resp = self.post(url, data)
+        if resp is None:
+            raise Exception('Unable to trigger build for {} {}'.format(repo, branch))
         self.build_num = resp['build_num']
         self.build_url = resp['build_url']
         # print "Build Number: {}".format(self._build_num)
         return resp
 
+    def cancel_build(self, repo, build_num):
+        # https://circleci.com/docs/api/v1-reference/#cancel-build
+        # POST: /project/:vcs-type/:username/:project/:build_num/cancel
+        url = '{}/{}/{}/cancel'.\
+            format(self.github_url, repo, build_num)
+        return self.post(url, None)
+
     def github_status_pending(self, context=None, url=None):
         if self.build_url is None:
             raise Exception('No build has been triggered.')
@@ -69,3 +135,11 @@ class CircleCIBase():
         desc = 'The integration build {} started'.format(self._build_num)
 
         GithubStatus().create_status('pending', self.build_url, desc, context, url=url)
+
+
+class AsyncCircleCIBase(AsyncClient):
+    """
+    CircleCIBase whose methods return an AsyncResult instead of blocking.
+    """
+    def __init__(self):
+        AsyncClient.__init__(self, CircleCIBase())
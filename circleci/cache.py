@@ -0,0 +1,92 @@
+import hashlib
+import json
+import os
+import tempfile
+
+MAX_ENTRIES = 1000
+MAX_BYTES = 50 * 1024 * 1024
+
+
+class ResponseCache():
+    """
+    On-disk cache of GET responses used to make conditional requests. Each
+    entry stores the validators (ETag, Last-Modified) and the decoded json
+    body of a response, one file per url, so it can be shared by separate
+    processes pointing at the same directory. The least recently used
+    entries are evicted once the cache grows past max_entries or max_bytes.
+    """
+    def __init__(self, path, max_entries=MAX_ENTRIES, max_bytes=MAX_BYTES):
+        self.path = path
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+
+    def key(self, url, headers):
+        # responses depend on who is asking, so the credentials are part of
+        # the key. they are hashed and never written to disk.
+        digest = hashlib.sha1(url.encode('utf-8'))
+        digest.update(headers.get('Authorization', '').encode('utf-8'))
+        return digest.hexdigest()
+
+    def entry_path(self, url, headers):
+        return os.path.join(self.path, self.key(url, headers) + '.json')
+
+    def load(self, url, headers):
+        path = self.entry_path(url, headers)
+        try:
+            with open(path, 'r') as f:
+                entry = json.load(f)
+            # bump mtime so eviction is least recently used
+            os.utime(path, None)
+        except (IOError, OSError, ValueError):
+            return None
+        return entry
+
+    def conditional_headers(self, entry):
+        headers = {}
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    def store(self, url, headers, resp):
+        etag = resp.headers.get('ETag')
+        last_modified = resp.headers.get('Last-Modified')
+        if etag is None and last_modified is None:
+            return
+        entry = {
+            'url': url,
+            'etag': etag,
+            'last_modified': last_modified,
+            'body': resp.json(),
+        }
+        # write then rename so concurrent readers never see a partial file
+        fd, tmp_path = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(entry, f)
+        os.rename(tmp_path, self.entry_path(url, headers))
+        self.evict()
+
+    def evict(self):
+        entries = []
+        total = 0
+        for name in os.listdir(self.path):
+            if not name.endswith('.json'):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.path, name))
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, name))
+            total += stat.st_size
+
+        entries.sort()
+        while entries and (len(entries) > self.max_entries or total > self.max_bytes):
+            mtime, size, name = entries.pop(0)
+            try:
+                os.remove(os.path.join(self.path, name))
+            except OSError:
+                pass
+            total -= size
@@ -0,0 +1,283 @@
+import json
+import logging
+import os
+import re
+import subprocess
+import threading
+import time
+from circleci.parallel import parallel_map
+from circleci.scheduler import get_scheduler
+from circleci.session import get_session
+
+COMPUTE_API_ENDPOINT = 'https://compute.googleapis.com/compute/v1'
+TOKEN_COMMAND = ['gcloud', 'auth', 'print-access-token']
+# gcloud access tokens last an hour, refresh them well before that
+TOKEN_LIFETIME = 45 * 60
+VM_DELETE_CMD = [
+    "gcloud",
+    "compute",
+    "instances",
+    "delete",
+    "--quiet"
+]
+# gcloud names the zone of a vm that is already gone
+VM_NOT_FOUND = "zones/{}/instances/{}' was not found"
+
+
+class GcloudBackend():
+    """
+    Lists and deletes vms by shelling out to gcloud. Vms are deleted in the
+    zone they were listed in, one gcloud call per zone.
+    """
+    def __init__(self):
+        # vm name to zone, from the last list
+        self.zones = {}
+        self.lock = threading.Lock()
+
+    def list_vms(self, prefixes):
+        return [name for name, zone in self.list_zones(
+            " ".join("condor-{}-*".format(p) for p in prefixes))]
+
+    def list_zones(self, names):
+        """
+        Args:
+        names (string): space separated names or patterns of vms
+
+        Returns:
+        (list): (name, zone) tuples
+        """
+        cmd = [
+            'gcloud',
+            'compute',
+            'instances',
+            'list',
+            '--filter',
+            "name:({})".format(names),
+            "--format=json(name,zone)"
+        ]
+        logging.debug(" ".join(cmd))
+        vm_out = subprocess.check_output(cmd)
+        vms = [(str(x['name']), str(x['zone']).split('/')[-1]) for x in json.loads(vm_out)]
+        with self.lock:
+            self.zones.update(vms)
+        return vms
+
+    def delete_vms(self, names):
+        with self.lock:
+            missing = [name for name in names if name not in self.zones]
+        # vms that are still missing afterwards are already gone
+        if missing:
+            self.list_zones(" ".join(missing))
+        by_zone = {}
+        with self.lock:
+            for name in names:
+                if name in self.zones:
+                    by_zone.setdefault(self.zones[name], []).append(name)
+
+        failed = []
+        for zone in sorted(by_zone):
+            cmd = VM_DELETE_CMD + ['--zone={}'.format(zone)] + by_zone[zone]
+            logging.debug(" ".join(cmd))
+            try:
+                logging.info(subprocess.check_output(cmd, stderr=subprocess.STDOUT))
+            except subprocess.CalledProcessError as exc:
+                output = exc.output or ''
+                if all(VM_NOT_FOUND.format(zone, name) in output for name in by_zone[zone]):
+                    continue
+                failed.append('{}: {}'.format(zone, output.strip() or exc))
+        if failed:
+            raise ComputeApiError('Unable to delete vms: {}'.format(', '.join(failed)))
+
+    def vm_deleter(self):
+        return self.delete_vms
+
+
+class ComputeApiError(Exception):
+    pass
+
+
+class ComputeApiBackend():
+    """
+    Lists and deletes vms through the compute API over the shared connection
+    pool. Vms of every zone are found with one aggregated list, and deletes
+    are sent for all zones at once before their operations are polled
+    together, instead of waiting for each vm in turn.
+    """
+    def __init__(self, project, token=None, endpoint=COMPUTE_API_ENDPOINT,
+                 page_size=500, poll_interval=2, operation_timeout=600, concurrency=None,
+                 token_command=None):
+        self.project = project
+        self.endpoint = endpoint.rstrip('/')
+        self.page_size = page_size
+        self.poll_interval = poll_interval
+        self.operation_timeout = operation_timeout
+        self.concurrency = concurrency
+        self.headers = {'Accept': 'application/json'}
+        if token is not None:
+            self.headers['Authorization'] = 'Bearer {}'.format(token)
+        # vm name to zone, from the last list
+        self.zones = {}
+        self.lock = threading.Lock()
+        self.session = get_session()
+        self.scheduler = get_scheduler()
+        # tokens printed by token_command expire, so they are fetched again
+        # before TOKEN_LIFETIME is up and whenever the api rejects them
+        self.token_command = token_command
+        self.token_expires = None
+        if token_command is not None:
+            self.refresh_token()
+
+    @classmethod
+    def from_environment(cls):
+        """
+        Reads the project from GOOGLE_PROJECT_ID and the access token from
+        GOOGLE_ACCESS_TOKEN. Without GOOGLE_ACCESS_TOKEN tokens come from
+        gcloud and are refreshed as they expire, a GOOGLE_ACCESS_TOKEN is
+        used as is and has to outlive the process.
+        """
+        project = os.environ.get('GOOGLE_PROJECT_ID')
+        if not project:
+            raise ComputeApiError('GOOGLE_PROJECT_ID must be set')
+        token = os.environ.get('GOOGLE_ACCESS_TOKEN')
+        return cls(
+            project,
+            token=token or None,
+            token_command=None if token else TOKEN_COMMAND,
+            endpoint=os.environ.get('COMPUTE_API_ENDPOINT', COMPUTE_API_ENDPOINT),
+        )
+
+    def refresh_token(self):
+        token = subprocess.check_output(self.token_command).strip().decode('utf-8')
+        with self.lock:
+            self.headers = dict(self.headers, Authorization='Bearer {}'.format(token))
+            self.token_expires = time.time() + TOKEN_LIFETIME
+
+    def request(self, verb, url, params=None):
+        func = getattr(self.session, verb)
+        if self.token_command is not None and time.time() >= self.token_expires:
+            self.refresh_token()
+        resp = self.scheduler.send(
+            self.endpoint, verb, func, url, headers=self.headers, params=params)
+        if resp.status_code == 401 and self.token_command is not None:
+            # revoked or expired early
+            self.refresh_token()
+            resp = self.scheduler.send(
+                self.endpoint, verb, func, url, headers=self.headers, params=params)
+        return resp
+
+    def project_url(self, path):
+        return '{}/projects/{}/{}'.format(self.endpoint, self.project, path)
+
+    def list_vms(self, prefixes):
+        # GET /projects/:project/aggregated/instances
+        return [
+            name for name, zone in self.aggregated_list(
+                'condor-({})-.*'.format('|'.join(re.escape(p) for p in prefixes)))
+        ]
+
+    def aggregated_list(self, name_regex):
+        """
+        Args:
+        name_regex (string): RE2 expression the whole vm name has to match
+
+        Returns:
+        (list): (name, zone) tuples
+        """
+        params = {
+            'filter': 'name eq "{}"'.format(name_regex),
+            'maxResults': self.page_size,
+            'returnPartialSuccess': 'true',
+        }
+        vms = []
+        while True:
+            resp = self.request('get', self.project_url('aggregated/instances'), params=params)
+            if resp.status_code != 200:
+                raise ComputeApiError(
+                    'Unable to list vms: {} {}'.format(resp.status_code, resp.text))
+            data = resp.json()
+            for scope in data.get('items', {}).values():
+                for instance in scope.get('instances', []):
+                    vms.append((str(instance['name']), instance['zone'].split('/')[-1]))
+            token = data.get('nextPageToken')
+            if not token:
+                break
+            params['pageToken'] = token
+        with self.lock:
+            self.zones.update(vms)
+        return vms
+
+    def delete_vms(self, names):
+        # DELETE /projects/:project/zones/:zone/instances/:name
+        by_zone = {}
+        for name, zone in self.zones_for(names):
+            by_zone.setdefault(zone, []).append(name)
+
+        failed = []
+        operations = []
+        # every zone's deletes are sent before any operation is waited on
+        targets = [(zone, name) for zone in sorted(by_zone) for name in by_zone[zone]]
+        for (zone, name), resp in zip(targets, parallel_map(
+                lambda target: self.request('delete', self.project_url(
+                    'zones/{}/instances/{}'.format(*target))),
+                targets, self.concurrency)):
+            # 404 is already gone
+            if resp.status_code == 404:
+                continue
+            if not 200 <= resp.status_code < 300:
+                failed.append('{}: {} {}'.format(name, resp.status_code, resp.text))
+                continue
+            operations.append((zone, name, resp.json()))
+
+        failed.extend(self.wait_for_operations(operations))
+        if failed:
+            raise ComputeApiError('Unable to delete vms: {}'.format(', '.join(failed)))
+
+    def zones_for(self, names):
+        with self.lock:
+            missing = [name for name in names if name not in self.zones]
+        # vms that are still missing afterwards are already gone
+        if missing:
+            self.aggregated_list('|'.join(re.escape(name) for name in missing))
+        with self.lock:
+            return [(name, self.zones.get(name)) for name in names if name in self.zones]
+
+    def wait_for_operations(self, operations):
+        """
+        Polls zone operations until every one of them is done.
+
+        Args:
+        operations (list): (zone, vm name, operation) tuples
+
+        Returns:
+        (list): failure messages
+        """
+        # GET /projects/:project/zones/:zone/operations/:operation
+        failed = []
+        deadline = time.time() + self.operation_timeout
+        while True:
+            pending = []
+            for zone, name, operation in operations:
+                if operation.get('status') != 'DONE':
+                    pending.append((zone, name, operation))
+                elif operation.get('error'):
+                    failed.append('{}: {}'.format(name, json.dumps(operation['error'])))
+            if not pending:
+                return failed
+            if time.time() >= deadline:
+                return failed + [
+                    '{}: operation {} timed out'.format(name, operation['name'])
+                    for zone, name, operation in pending
+                ]
+            time.sleep(self.poll_interval)
+            operations = []
+            for (zone, name, operation), resp in zip(pending, parallel_map(
+                    lambda op: self.request('get', self.project_url(
+                        'zones/{}/operations/{}'.format(op[0], op[2]['name']))),
+                    pending, self.concurrency)):
+                if resp.status_code != 200:
+                    failed.append('{}: {} {}'.format(name, resp.status_code, resp.text))
+                else:
+                    operations.append((zone, name, resp.json()))
+
+    def vm_deleter(self):
+        return self.delete_vms
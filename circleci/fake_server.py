@@ -0,0 +1,43 @@
+import json
+import threading
+import unittest
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+
+
+class FakeApi(BaseHTTPRequestHandler):
+    """
+    Base of the request handlers that fake an api in the backend tests.
+    """
+    def log_message(self, *args):
+        pass
+
+    def send_json(self, code, data):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class FakeServerTestCase(unittest.TestCase):
+    """
+    Serves handler on a local port for the duration of every test, the
+    address is in self.address.
+    """
+    handler = FakeApi
+
+    def setUp(self):
+        self.server = HTTPServer(('127.0.0.1', 0), self.handler)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.address = 'http://127.0.0.1:{}'.format(self.server.server_port)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
@@ -2,12 +2,25 @@ import argparse
 import json
 import os
 import re
+import threading
 import requests
 import yaml
+from collections import OrderedDict
+from circleci.cache import MAX_BYTES, MAX_ENTRIES, ResponseCache
+from circleci.parallel import parallel_map
+from circleci.scheduler import get_scheduler
+from circleci.session import get_session
+
+PULL_REQUEST_URL_REGEX = '^https?:\/\/github.com\/(.*)\/(.*)\/pull\/(\d+)\/?$'
+# pull requests fetched per graphql query, github limits query cost
+GRAPHQL_CHUNK_SIZE = 50
+PULL_REQUEST_FIELDS = 'body state headRefOid headRefName headRepository { nameWithOwner }'
+# how many links away from the first pull request linked ones are followed
+LINK_DEPTH = 5
 
 
 class Github():
-    def __init__(self):
+    def __init__(self, cache_dir=None):
         self.github_api = 'https://api.github.com'
         self.oauth = os.environ.get('GH_OAUTH_TOKEN')
         if self.oauth is None:
@@ -16,14 +29,40 @@ class Github():
             'Authorization': 'token {}'.format(self.oauth),
             'Content-Type': 'application/json'
         }
+        self.session = get_session()
+        self.scheduler = get_scheduler()
+
+        # optional on-disk cache for conditional GETs, 304 responses do not
+        # count against the github rate limit
+        if cache_dir is None:
+            cache_dir = os.environ.get('GH_CACHE_DIR')
+        self.cache = None
+        if cache_dir:
+            self.cache = ResponseCache(
+                cache_dir,
+                max_entries=int(os.environ.get('GH_CACHE_MAX_ENTRIES', MAX_ENTRIES)),
+                max_bytes=int(os.environ.get('GH_CACHE_MAX_BYTES', MAX_BYTES)),
+            )
 
     def request(self, verb, url, data=None):
+        entry = None
         if verb == 'get':
-            resp = requests.get(url, headers=self.headers)
+            headers = self.headers
+            if self.cache is not None:
+                entry = self.cache.load(url, self.headers)
+                if entry is not None:
+                    headers = dict(self.headers, **self.cache.conditional_headers(entry))
+            resp = self.scheduler.send(
+                self.oauth, verb, self.session.get, url, headers=headers)
         elif verb == 'post':
-            resp = requests.post(url, headers=self.headers, data=data)
-
-        if 200 <= resp.status_code < 300:
+            resp = self.scheduler.send(
+                self.oauth, verb, self.session.post, url, headers=self.headers, data=data)
+
+        if entry is not None and resp.status_code == 304:
+            return entry['body']
+        elif 200 <= resp.status_code < 300:
+            if verb == 'get' and self.cache is not None:
+                self.cache.store(url, self.headers, resp)
             return resp.json()
         else:
             print("{} {} request failed".format(url, verb))
@@ -35,15 +74,74 @@ class Github():
     def post(self, url, data):
         return self.request('post', url, data=data)
 
+    def graphql(self, query, variables=None):
+        # https://developer.github.com/v4/
+        # POST /graphql
+        resp = self.post('{}/graphql'.format(self.github_api), json.dumps({
+            'query': query,
+            'variables': variables or {},
+        }))
+        if resp is None:
+            raise Exception('GraphQL query failed')
+        return resp
+
+
 class GithubPullRequest(Github):
-    def __init__(self, url):
+    def __init__(self, url, fetch=True):
         Github.__init__(self)
         self.url = url
         self.parse_url()
-        self.parse_pr()
+        if fetch:
+            self.parse_pr()
+
+    @classmethod
+    def fetch_many(cls, urls, chunk_size=GRAPHQL_CHUNK_SIZE, concurrency=None):
+        """
+        Fetches many pull requests with one graphql query per chunk_size
+        pull requests instead of one request each.
+
+        Returns:
+        (list): GithubPullRequest for each url, in order
+        """
+        prs = [cls(url, fetch=False) for url in urls]
+        chunks = [prs[i:i + chunk_size] for i in range(0, len(prs), chunk_size)]
+        parallel_map(cls._fetch_chunk, chunks, concurrency)
+        return prs
+
+    @staticmethod
+    def _fetch_chunk(prs):
+        # one aliased pullRequest lookup per pull request
+        params = []
+        selections = []
+        variables = {}
+        for i, pr in enumerate(prs):
+            params.append('$owner{0}: String!, $name{0}: String!, $number{0}: Int!'.format(i))
+            selections.append(
+                'pr{0}: repository(owner: $owner{0}, name: $name{0}) '
+                '{{ pullRequest(number: $number{0}) {{ {1} }} }}'.format(i, PULL_REQUEST_FIELDS))
+            variables['owner{}'.format(i)] = pr.owner
+            variables['name{}'.format(i)] = pr.repo
+            variables['number{}'.format(i)] = int(pr.number)
+        query = 'query({}) {{ {} }}'.format(', '.join(params), ' '.join(selections))
+
+        data = prs[0].graphql(query, variables).get('data') or {}
+        for i, pr in enumerate(prs):
+            node = (data.get('pr{}'.format(i)) or {}).get('pullRequest')
+            if node is None:
+                raise Exception('Unable to fetch pull request {}'.format(pr.url))
+            # same shape as the rest api response
+            pr.load({
+                'body': node['body'],
+                'state': 'open' if node['state'] == 'OPEN' else 'closed',
+                'head': {
+                    'sha': node['headRefOid'],
+                    'ref': node['headRefName'],
+                    'repo': {'full_name': (node['headRepository'] or {}).get('nameWithOwner')},
+                },
+            })
 
     def parse_url(self):
-        result = re.search('^https?:\/\/github.com\/(.*)\/(.*)\/pull\/(\d+)\/?$', self.url)
+        result = re.search(PULL_REQUEST_URL_REGEX, self.url)
         if result is None:
             raise ValueError('ERROR: Invalid url: ' + self.url)
         else:
@@ -63,7 +161,15 @@ class GithubPullRequest(Github):
 
     def parse_pr(self):
         pr = self.get(self.pr_api_url)
+        if pr is None:
+            raise Exception('Unable to fetch pull request {}'.format(self.url))
+        self.load(pr)
 
+    def load(self, pr):
+        """
+        Args:
+        pr (dict): pull request as returned by the rest api
+        """
         self.description = pr['body']
         self.sha = pr['head']['sha']
         self.repo_full_name = pr['head']['repo']['full_name']
@@ -124,6 +230,116 @@ class GithubPullRequest(Github):
         return None
 
 
+class PullRequestRegistry():
+    """
+    Identity map of GithubPullRequest objects keyed by canonical pull request
+    url, so each pull request is fetched from github once per run no matter
+    how many times, or how many spellings of its url, it is looked up.
+    """
+    def __init__(self, concurrency=None, graphql=False):
+        self.pull_requests = {}
+        self.concurrency = concurrency
+        self.graphql = graphql
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def canonical_url(url):
+        result = re.search(PULL_REQUEST_URL_REGEX, url.strip())
+        if result is None:
+            raise ValueError('ERROR: Invalid url: ' + url)
+        # github owner and repo names are case insensitive
+        return 'https://github.com/{}/{}/pull/{}'.format(
+            result.group(1).lower(),
+            result.group(2).lower(),
+            result.group(3)
+        )
+
+    def get(self, url):
+        key = self.canonical_url(url)
+        with self.lock:
+            pr = self.pull_requests.get(key)
+        if pr is None:
+            pr = self._add(key, GithubPullRequest(url))
+        return pr
+
+    def fetch_all(self, urls):
+        """
+        Resolves every pull request not already in the registry concurrently,
+        bounded by the registry concurrency limit. With graphql they are
+        fetched in batched queries instead of one request each.
+
+        Returns:
+        (list): GithubPullRequest for each url, in order
+        """
+        missing = {}
+        for url in urls:
+            key = self.canonical_url(url)
+            if key not in self.pull_requests:
+                missing[key] = url
+
+        if self.graphql:
+            keys = list(missing)
+            prs = GithubPullRequest.fetch_many(
+                [missing[key] for key in keys], concurrency=self.concurrency)
+            for key, pr in zip(keys, prs):
+                self._add(key, pr)
+        else:
+            def fetch(key):
+                return self._add(key, GithubPullRequest(missing[key]))
+
+            parallel_map(fetch, missing.keys(), self.concurrency)
+        return [self.get(url) for url in urls]
+
+    def resolve(self, urls, depth=LINK_DEPTH):
+        """
+        Follows the pull_requests block of every pull request description
+        breadth first, fetching each level concurrently, so pull requests
+        linked from linked pull requests are found too. Every pull request is
+        visited once, cycles end the walk. Links of closed pull requests are
+        not followed.
+
+        Args:
+        urls (list): pull request urls to start from
+        depth (int): how many links to follow, 1 only adds the pull requests
+        linked directly
+
+        Returns:
+        (list): url of every pull request found, breadth first
+        """
+        result = []
+        visited = set()
+        frontier = []
+        for url in urls:
+            key = self.canonical_url(url)
+            if key not in visited:
+                visited.add(key)
+                frontier.append(url)
+        level = 0
+        while frontier:
+            result.extend(frontier)
+            prs = self.fetch_all(frontier)
+            if level >= depth:
+                break
+            frontier = []
+            for pr in prs:
+                # a closed or merged pull request is dropped from the
+                # integration, so what it links to is not pulled in either
+                if not pr.active:
+                    continue
+                for url in sorted(pr.pull_requests()):
+                    key = self.canonical_url(url)
+                    if key not in visited:
+                        visited.add(key)
+                        frontier.append(url)
+            level += 1
+        return result
+
+    def _add(self, key, pr):
+        # first writer wins so every caller shares the same object
+        with self.lock:
+            return self.pull_requests.setdefault(key, pr)
+
+
 class GithubStatus(Github):
     # https://developer.github.com/v3/repos/statuses
     def __init__(self):
@@ -158,6 +374,24 @@ class GithubStatus(Github):
         print('Updating status for commit {}:\n{}'.format(url, data))
         return self.post(url, data)
 
+    def create_statuses(self, state, target_url, description, context,
+                        urls, concurrency=None):
+        """
+        Posts the same status to every commit status url concurrently.
+
+        Returns:
+        (OrderedDict): url to response, None for urls that failed
+        """
+        def create(url):
+            try:
+                return self.create_status(
+                    state, target_url, description, context, url=url)
+            except requests.RequestException as exc:
+                print("{} post request failed: {}".format(url, exc))
+
+        results = parallel_map(create, urls, concurrency)
+        return OrderedDict(zip(urls, results))
+
     def get_combined_status(self, url=None, owner=None, repo=None, ref=None):
         # https://developer.github.com/v3/repos/statuses/#get-the-combined-status-for-a-specific-ref
         # GET /repos/:owner/:repo/commits/:ref/status
@@ -188,6 +422,10 @@ def arg_parser():
         '-c', '--context', type=str, default='ci/circleci-integration',
         help='A string label to differentiate this status from other systems'
     )
+    p.add_argument(
+        '--concurrency', type=int, default=None,
+        help='Max number of statuses posted to github concurrently'
+    )
     return p.parse_args()
 
 
@@ -203,6 +441,8 @@ def status_cli():
     if os.environ.get('STATUS_CONTEXT'):
         context = os.environ.get('STATUS_CONTEXT')
 
-    for url in args.url.split(','):
-        print(GithubStatus().create_status(
-            args.state, args.target, args.description, context, url=url))
+    results = GithubStatus().create_statuses(
+        args.state, args.target, args.description, context,
+        args.url.split(','), concurrency=args.concurrency)
+    for url, result in results.items():
+        print(result)
@@ -1,24 +1,47 @@
 import argparse
+import hashlib
+import itertools
 import os
 import json
+import tempfile
+from collections import OrderedDict
 
+import requests
 from jsonmerge import merge
-from circleci.base import CircleCIBase
-from circleci.github import GithubPullRequest, GithubStatus
+from circleci.base import AsyncCircleCIBase, CircleCIBase
+from circleci.github import LINK_DEPTH, GithubStatus, PullRequestRegistry
+
+# successful builds searched for a result that can be reused
+RESULT_HISTORY = 100
 
 
 class Integration():
-    def __init__(self, repo, branch='master', build_param={}, context='ci/circleci-integration'):
+    def __init__(self, repo, branch='master', build_param={}, context='ci/circleci-integration',
+                 concurrency=None, jsonmerge=False, depth=LINK_DEPTH, graphql=False,
+                 dedupe=True, cancel_superseded=False, reuse_results=False, results_file=None):
         self.build_param = build_param
         self.repo = repo
         self.branch = branch
         self.context = context
         self.status_urls = []
+        self.concurrency = concurrency
+        self.jsonmerge = jsonmerge
+        self.depth = depth
+        self.dedupe = dedupe
+        self.cancel_superseded = cancel_superseded
+        self.reuse_results = reuse_results
+        self.results = None
+        if results_file is not None:
+            self.results = ResultStore(results_file)
+        self.pr_heads = OrderedDict()
+        self.pull_request_registry = PullRequestRegistry(concurrency=concurrency, graphql=graphql)
 
     def filter_active_pr(self, pull_requests):
+        # resolve all linked PRs at once, later passes hit the registry
+        self.pull_request_registry.fetch_all(pull_requests)
         result = []
         for pr in pull_requests:
-            if GithubPullRequest(pr).active:
+            if self.pull_request_registry.get(pr).active:
                 result = result + [pr]
             else:
                 print("{} is not open and dropped from integration tests".format(pr))
@@ -27,7 +50,7 @@ class Integration():
     def filter_integration_branch(self, pull_requests):
         result = []
         for pr in pull_requests:
-            p = GithubPullRequest(pr)
+            p = self.pull_request_registry.get(pr)
             if p.repo_full_name.lower() == self.repo.lower():
                 print("Switching integration to {} branch {}".format(pr, p.branch))
                 self.branch = p.branch
@@ -36,36 +59,173 @@ class Integration():
         return result
 
     def run(self):
+        listing = None
+        if os.environ.get('CIRCLE_PULL_REQUEST') and (self.dedupe or self.cancel_superseded):
+            listing = self.list_running_builds()
+
         if os.environ.get('CIRCLE_PULL_REQUEST'):
             # NOTE: This is integration for a PR
-            current_pr = GithubPullRequest(os.environ.get('CIRCLE_PULL_REQUEST'))
-            pull_requests = self.filter_active_pr(current_pr.pull_requests())
+            pull_requests = self.filter_active_pr(self.pull_request_registry.resolve(
+                [os.environ.get('CIRCLE_PULL_REQUEST')], depth=self.depth))
             pull_requests = self.filter_integration_branch(pull_requests)
             # NOTE: make sure current PR is in the set
-            pull_requests = set(pull_requests + [os.environ.get('CIRCLE_PULL_REQUEST')])
+            pull_requests = sorted(set(pull_requests + [os.environ.get('CIRCLE_PULL_REQUEST')]))
             self.build_param['PR_URL'] = ','.join(pull_requests)
 
-            self.status_urls = [ GithubPullRequest(pr).status_url for pr in pull_requests ]
+            self.pr_heads = OrderedDict(
+                (self.pull_request_registry.canonical_url(pr), self.pull_request_registry.get(pr).sha)
+                for pr in pull_requests
+            )
+            self.build_param['PR_HEADS'] = json.dumps(self.pr_heads)
+
+            self.status_urls = [ self.pull_request_registry.get(pr).status_url for pr in pull_requests ]
             self.build_param['STATUS_URL'] = ','.join(self.status_urls)
             self.build_param['STATUS_CONTEXT'] = self.context
 
-            custom_values = {}
-            for pr in pull_requests:
-                custom_values = merge(custom_values, GithubPullRequest(pr).custom_value())
-
+            pr_values = [self.pull_request_registry.get(pr).custom_value() for pr in pull_requests]
+            user_values = {}
             if 'CUSTOM_VALUES' in self.build_param:
                 try:
-                    user_values = json.loads(self.build_param['CUSTOM_VALUES'])
+                    user_values = json.loads(self.build_param['CUSTOM_VALUES'],
+                                             object_pairs_hook=OrderedDict)
                 except ValueError:
                     print('Unable to parse json value: {}'.format(self.build_param['CUSTOM_VALUES']))
                     raise
-                self.build_param['CUSTOM_VALUES'] = json.dumps(merge(user_values, custom_values))
+
+            if self.jsonmerge:
+                custom_values = {}
+                for value in pr_values:
+                    custom_values = merge(custom_values, value)
+                custom_values = merge(user_values, custom_values)
             else:
-                self.build_param['CUSTOM_VALUES'] = json.dumps(custom_values)
+                custom_values = merge_custom_values(user_values, pr_values)
+            self.build_param['CUSTOM_VALUES'] = json.dumps(custom_values)
+            self.build_param['INTEGRATION_FINGERPRINT'] = self.fingerprint()
+
+        builds = []
+        if listing is not None:
+            builds = self.running_builds(listing)
+        # builds of older commits are stale whether or not a result is reused
+        if self.cancel_superseded:
+            self.cancel_superseded_builds(builds)
+
+        if self.reuse_results and self.reuse_passed_build():
+            return
 
-        self.build()
+        if not (self.dedupe and self.attach_to_running_build(builds)):
+            self.build()
         self.update_status()
 
+    def fingerprint(self):
+        """
+        Identifies an integration build by its repo, branch and resolved build
+        parameters, which hold the PR head SHAs and the custom values.
+        """
+        params = dict(
+            (k, v) for k, v in self.build_param.items() if k != 'INTEGRATION_FINGERPRINT')
+        return hashlib.sha1(json.dumps(
+            [self.repo, self.branch, params], sort_keys=True).encode('utf-8')).hexdigest()
+
+    def attach_to_running_build(self, builds):
+        # a build for the same fingerprint is already queued or running, so
+        # the statuses point at it instead of starting a duplicate
+        fingerprint = self.build_param.get('INTEGRATION_FINGERPRINT')
+        if fingerprint is None:
+            return False
+        for build in builds:
+            params = build.get('build_parameters') or {}
+            if params.get('INTEGRATION_FINGERPRINT') == fingerprint:
+                self.build_num = build['build_num']
+                self.build_url = build['build_url']
+                print("Integration build {} is already running for these commits".format(
+                    self.build_num))
+                return True
+        return False
+
+    def reuse_passed_build(self):
+        # the same commits and values already passed integration, so report
+        # that result instead of building them again
+        fingerprint = self.build_param.get('INTEGRATION_FINGERPRINT')
+        if fingerprint is None:
+            return False
+        build = self.find_passed_build(fingerprint)
+        if build is None:
+            return False
+        self.build_num = build['build_num']
+        self.build_url = build['build_url']
+        print("Integration build {} already passed for these commits".format(self.build_num))
+        desc = 'The integration build {} passed'.format(self.build_num)
+        GithubStatus().create_statuses(
+            'success', self.build_url, desc, self.context,
+            self.status_urls, concurrency=self.concurrency)
+        return True
+
+    def find_passed_build(self, fingerprint):
+        """
+        Looks the fingerprint up in the results file, then in the most recent
+        successful builds of the branch.
+
+        Returns:
+        (dict): build_num and build_url of the passed build, or None
+        """
+        if self.results is not None:
+            build = self.results.get(fingerprint)
+            if build is not None:
+                return build
+        try:
+            builds = itertools.islice(CircleCIBase().iter_builds(
+                self.repo, branch=self.branch, filter='successful'), RESULT_HISTORY)
+            for build in builds:
+                params = build.get('build_parameters') or {}
+                if params.get('INTEGRATION_FINGERPRINT') == fingerprint:
+                    build = {'build_num': build['build_num'], 'build_url': build['build_url']}
+                    if self.results is not None:
+                        self.results.put(fingerprint, build)
+                    return build
+        except ValueError as exc:
+            print('Unable to list successful builds: {}'.format(exc))
+        return None
+
+    def cancel_superseded_builds(self, builds):
+        """
+        Cancels running builds testing an older commit of any of the pull
+        requests in this integration.
+
+        Returns:
+        (list): build numbers cancelled
+        """
+        cancelled = []
+        for build in builds:
+            params = build.get('build_parameters') or {}
+            try:
+                heads = json.loads(params.get('PR_HEADS') or '{}')
+            except ValueError:
+                continue
+            stale = [
+                url for url in heads
+                if url in self.pr_heads and heads[url] != self.pr_heads[url]
+            ]
+            if not stale:
+                continue
+            print("Cancelling build {}, superseded by new commits on {}".format(
+                build['build_num'], ', '.join(sorted(stale))))
+            if CircleCIBase().cancel_build(self.repo, build['build_num']) is not None:
+                cancelled.append(build['build_num'])
+        return cancelled
+
+    def list_running_builds(self):
+        # the running builds only depend on the repo, so they are listed in
+        # the background while the pull requests are resolved
+        return AsyncCircleCIBase().iter_builds(self.repo)
+
+    def running_builds(self, listing):
+        try:
+            return listing.get()
+        except (ValueError, requests.RequestException) as exc:
+            # the listing only avoids duplicate builds, without it one is triggered
+            print('Unable to list running builds: {}'.format(exc))
+            return []
+
     def build(self):
         data = json.dumps({'build_parameters': self.build_param})
         result = CircleCIBase().trigger_build(self.repo, self.branch, data)
@@ -74,10 +234,77 @@ class Integration():
         print("Build Number:{}".format(self.build_num))
 
     def update_status(self):
-        for url in self.status_urls:
-            desc = 'The integration build {} started'.format(self.build_num)
-            GithubStatus().create_status(
-                'pending', self.build_url, desc, self.context, url=url)
+        desc = 'The integration build {} started'.format(self.build_num)
+        return GithubStatus().create_statuses(
+            'pending', self.build_url, desc, self.context,
+            self.status_urls, concurrency=self.concurrency)
+
+
+class ResultStore():
+    """
+    JSON file of integration build fingerprints known to have passed, so
+    they are found without searching the build history.
+    """
+    def __init__(self, path):
+        self.path = path
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def get(self, fingerprint):
+        return self.load().get(fingerprint)
+
+    def put(self, fingerprint, build):
+        results = self.load()
+        results[fingerprint] = build
+        # written to a temp file and renamed so readers never see half a file
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.path)))
+        with os.fdopen(fd, 'w') as f:
+            json.dump(results, f)
+        os.rename(tmp, self.path)
+
+
+def merge_custom_values(user_values, pr_values):
+    """
+    Merges custom values of the form {chart: {repo, tag}} in one pass. The
+    pull request values are laid over the user values, overriding their
+    tags is expected, but pull requests giving a chart different tags are
+    reported. Settings of a chart are merged one level deep, deeper user
+    values need the jsonmerge fallback.
+
+    Args:
+    user_values (dict): CUSTOM_VALUES given to the integration
+    pr_values (list): custom values of each pull request, later ones win
+
+    Returns:
+    (OrderedDict): chart to settings
+    """
+    prs = OrderedDict()
+    for value in pr_values:
+        for chart, settings in value.items():
+            current = prs.get(chart)
+            if isinstance(current, dict) and isinstance(settings, dict):
+                if 'tag' in current and 'tag' in settings and current['tag'] != settings['tag']:
+                    print("Conflicting tags for {}: {} and {}, using {}".format(
+                        chart, current['tag'], settings['tag'], settings['tag']))
+            prs[chart] = _merge_settings(current, settings)
+
+    result = OrderedDict(user_values)
+    for chart, settings in prs.items():
+        result[chart] = _merge_settings(result.get(chart), settings)
+    return result
+
+
+def _merge_settings(current, settings):
+    if isinstance(current, dict) and isinstance(settings, dict):
+        merged = dict(current)
+        merged.update(settings)
+        return merged
+    return settings
 
 
 def arg_parser():
@@ -86,6 +313,22 @@ def arg_parser():
     p.add_argument('-V', '--VALUE', action='append', nargs=1)
     p.add_argument('-c', '--context', type=str, default='ci/circleci-integration',
                    help='A string label to differentiate this status from other systems')
+    p.add_argument('--concurrency', type=int, default=None,
+                   help='Max number of concurrent github requests')
+    p.add_argument('--depth', type=int, default=LINK_DEPTH,
+                   help='How many levels of linked pull requests to follow')
+    p.add_argument('--graphql', action='store_true', default=False,
+                   help='Fetch linked pull requests with batched graphql queries')
+    p.add_argument('--no-dedupe', action='store_true', default=False,
+                   help='Trigger a build even if one is running for the same commits')
+    p.add_argument('--cancel-superseded', action='store_true', default=False,
+                   help='Cancel running builds for older commits of the same pull requests')
+    p.add_argument('--reuse-results', action='store_true', default=False,
+                   help='Report success without building when the same commits already passed')
+    p.add_argument('--results-file', type=str, default=None,
+                   help='JSON file remembering passed builds (with --reuse-results)')
+    p.add_argument('--jsonmerge', action='store_true', default=False,
+                   help='Deep merge CUSTOM_VALUES with jsonmerge instead of per chart')
 
     p.add_argument('repo', type=str, help='github org/repo')
     p.add_argument('branch', type=str, help='git branch to test')
@@ -101,5 +344,9 @@ def cli():
         else:
             for i, val in enumerate(args.KEY):
                 params[val[0]] = args.VALUE[i][0]
-    integration = Integration(args.repo, branch=args.branch, build_param=params, context=args.context)
+    integration = Integration(args.repo, branch=args.branch, build_param=params, context=args.context,
+                              concurrency=args.concurrency, jsonmerge=args.jsonmerge,
+                              depth=args.depth, graphql=args.graphql, dedupe=not args.no_dedupe,
+                              cancel_superseded=args.cancel_superseded,
+                              reuse_results=args.reuse_results, results_file=args.results_file)
     integration.run()
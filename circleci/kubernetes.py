@@ -0,0 +1,250 @@
+import atexit
+import base64
+import json
+import logging
+import os
+import subprocess
+import tempfile
+import yaml
+from circleci.scheduler import get_scheduler
+from circleci.session import get_session
+
+SERVICE_ACCOUNT_DIR = '/var/run/secrets/kubernetes.io/serviceaccount'
+# kubectl output for a namespace that is deleted, already gone or already
+# terminating
+NAMESPACE_DELETED = [
+    'namespace "{}" deleted',
+    'namespaces "{}" not found',
+    'Operation cannot be fulfilled on namespaces "{}": The system is ensuring all content is removed',
+]
+
+
+class KubectlBackend():
+    """
+    Lists and deletes namespaces by shelling out to kubectl.
+    """
+    def list_namespaces(self):
+        names = []
+        ns_out = subprocess.check_output(["kubectl", "get", "ns"])
+        for line in ns_out.rstrip().split("\n")[1:]:
+            spl_line = line.split()
+            if spl_line[1] == 'Active':
+                names.append(spl_line[0])
+        return names
+
+    def delete_namespaces(self, names):
+        cmd = ["kubectl", "delete", "ns"] + names
+        logging.debug(" ".join(cmd))
+        try:
+            logging.info(subprocess.check_output(cmd, stderr=subprocess.STDOUT))
+        except subprocess.CalledProcessError as exc:
+            # kubectl deletes what it can before failing, like the api's 404
+            # and 409 a namespace already gone or terminating is fine
+            output = exc.output or ''
+            if not all(
+                    any(line.format(name) in output for line in NAMESPACE_DELETED)
+                    for name in names):
+                raise
+
+    def namespace_deleter(self):
+        return self.delete_namespaces
+
+
+class KubernetesApiError(Exception):
+    pass
+
+
+class KubernetesApiBackend():
+    """
+    Lists and deletes namespaces through the kubernetes API over the shared
+    connection pool. Only Active namespaces are returned by the server, and
+    a label selector narrows the list further when build namespaces are
+    labelled.
+    """
+    def __init__(self, server, token=None, verify=True, cert=None,
+                 label_selector=None, page_size=500, temp_files=None):
+        self.server = server.rstrip('/')
+        # certificates and keys written out from the kubeconfig, removed by
+        # close or at exit
+        self.temp_files = temp_files or []
+        if self.temp_files:
+            atexit.register(self.close)
+        self.verify = verify
+        self.cert = cert
+        self.label_selector = label_selector
+        self.page_size = page_size
+        self.resource_version = None
+        self.headers = {'Accept': 'application/json'}
+        if token is not None:
+            self.headers['Authorization'] = 'Bearer {}'.format(token)
+        self.session = get_session()
+        self.scheduler = get_scheduler()
+
+    @classmethod
+    def from_environment(cls, label_selector=None):
+        """
+        Uses the pod service account when running inside the cluster and the
+        current context of the kubeconfig otherwise.
+        """
+        host = os.environ.get('KUBERNETES_SERVICE_HOST')
+        if host is not None:
+            with open(os.path.join(SERVICE_ACCOUNT_DIR, 'token')) as f:
+                token = f.read().strip()
+            return cls(
+                'https://{}:{}'.format(host, os.environ.get('KUBERNETES_SERVICE_PORT', 443)),
+                token=token,
+                verify=os.path.join(SERVICE_ACCOUNT_DIR, 'ca.crt'),
+                label_selector=label_selector,
+            )
+        return cls.from_kubeconfig(label_selector=label_selector)
+
+    @classmethod
+    def from_kubeconfig(cls, path=None, label_selector=None):
+        if path is None:
+            path = os.environ.get('KUBECONFIG', os.path.expanduser('~/.kube/config'))
+        with open(path) as f:
+            config = yaml.safe_load(f)
+
+        context_name = config['current-context']
+        context = [c['context'] for c in config['contexts'] if c['name'] == context_name][0]
+        cluster = [c['cluster'] for c in config['clusters'] if c['name'] == context['cluster']][0]
+        user = [u['user'] for u in config['users'] if u['name'] == context['user']][0]
+        for key in ('auth-provider', 'exec'):
+            if key in user:
+                raise KubernetesApiError(
+                    'kubeconfig user {} authenticates with {}, which the api backend does not '
+                    'support. Use a token or client certificate, or the kubectl backend.'.format(
+                        context['user'], key))
+
+        temp_files = []
+        try:
+            verify = not cluster.get('insecure-skip-tls-verify', False)
+            if verify:
+                verify = _file_or_data(cluster, 'certificate-authority', temp_files) or True
+            cert = None
+            client_cert = _file_or_data(user, 'client-certificate', temp_files)
+            if client_cert is not None:
+                cert = (client_cert, _file_or_data(user, 'client-key', temp_files))
+        except Exception:
+            _remove(temp_files)
+            raise
+        return cls(
+            cluster['server'],
+            token=user.get('token'),
+            verify=verify,
+            cert=cert,
+            label_selector=label_selector,
+            temp_files=temp_files,
+        )
+
+    def close(self):
+        _remove(self.temp_files)
+        self.temp_files = []
+
+    def request(self, verb, url, params=None):
+        func = getattr(self.session, verb)
+        return self.scheduler.send(
+            self.server, verb, func, url, headers=self.headers, params=params,
+            verify=self.verify, cert=self.cert)
+
+    def list_namespaces(self):
+        # GET /api/v1/namespaces
+        params = {
+            'fieldSelector': 'status.phase=Active',
+            'limit': self.page_size,
+        }
+        if self.label_selector:
+            params['labelSelector'] = self.label_selector
+
+        names = []
+        while True:
+            resp = self.request('get', '{}/api/v1/namespaces'.format(self.server), params=params)
+            if resp.status_code != 200:
+                raise KubernetesApiError(
+                    'Unable to list namespaces: {} {}'.format(resp.status_code, resp.text))
+            data = resp.json()
+            names.extend(item['metadata']['name'] for item in data.get('items', []))
+            # watches resume from the version of the last full list
+            self.resource_version = data.get('metadata', {}).get('resourceVersion')
+            token = data.get('metadata', {}).get('continue')
+            if not token:
+                return names
+            params['continue'] = token
+
+    def watch_namespaces(self, timeout=300):
+        """
+        Streams namespace changes since the last list or watch event. The
+        stream ends after timeout seconds and can simply be watched again.
+
+        Yields:
+        (tuple): event type (ADDED, MODIFIED, DELETED), name and phase
+        """
+        # GET /api/v1/namespaces?watch=true
+        params = {
+            'watch': 'true',
+            'timeoutSeconds': timeout,
+        }
+        if self.resource_version:
+            params['resourceVersion'] = self.resource_version
+        if self.label_selector:
+            params['labelSelector'] = self.label_selector
+
+        resp = self.session.get(
+            '{}/api/v1/namespaces'.format(self.server), headers=self.headers,
+            params=params, verify=self.verify, cert=self.cert, stream=True,
+            timeout=timeout + 30)
+        try:
+            if resp.status_code != 200:
+                raise KubernetesApiError(
+                    'Unable to watch namespaces: {} {}'.format(resp.status_code, resp.text))
+            for line in resp.iter_lines():
+                if not line:
+                    continue
+                event = json.loads(line)
+                obj = event['object']
+                if event['type'] == 'ERROR':
+                    # usually 410 Gone, the caller has to list again
+                    self.resource_version = None
+                    raise KubernetesApiError(
+                        'Namespace watch failed: {}'.format(obj.get('message')))
+                self.resource_version = obj['metadata'].get('resourceVersion')
+                yield event['type'], obj['metadata']['name'], obj.get('status', {}).get('phase')
+        finally:
+            resp.close()
+
+    def delete_namespaces(self, names):
+        # DELETE /api/v1/namespaces/:name
+        failed = []
+        for name in names:
+            resp = self.request('delete', '{}/api/v1/namespaces/{}'.format(self.server, name))
+            # 404 is already gone, 409 is already terminating
+            if not (200 <= resp.status_code < 300 or resp.status_code in (404, 409)):
+                failed.append('{}: {} {}'.format(name, resp.status_code, resp.text))
+        if failed:
+            raise KubernetesApiError('Unable to delete namespaces: {}'.format(', '.join(failed)))
+
+    def namespace_deleter(self):
+        return self.delete_namespaces
+
+
+def _file_or_data(config, key, temp_files):
+    # kubeconfig entries hold either a path or inline base64 data, requests
+    # only accepts paths
+    if config.get(key):
+        return config[key]
+    data = config.get('{}-data'.format(key))
+    if data is None:
+        return None
+    fd, path = tempfile.mkstemp(suffix='.pem')
+    temp_files.append(path)
+    with os.fdopen(fd, 'wb') as f:
+        f.write(base64.b64decode(data))
+    return path
+
+
+def _remove(paths):
+    for path in paths:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
@@ -1,107 +1,210 @@
 import argparse
-import json
 import logging
 import subprocess
 import sys
 import re
+import threading
+import time
+import requests
+from collections import OrderedDict
 from circleci.base import CircleCIBase
+from circleci.compute import ComputeApiBackend, ComputeApiError, GcloudBackend
+from circleci.kubernetes import KubectlBackend, KubernetesApiBackend, KubernetesApiError
+from circleci.parallel import parallel_map
+from circleci.state import RETRY_AFTER, GCStateStore
+
+HELM_DELETE_CMD = ["helm", "delete", "--purge"]
+# helm reports a release that is already gone like this
+NOT_FOUND = '"{}" not found'
+
+
+class Inventory():
+    """
+    Snapshot of the cluster resources found during one GC pass. Each resource
+    type maps a build number to the full names of the objects created for
+    that build, so the delete phases never have to list or parse them again.
+    """
+    def __init__(self, namespaces=None, vms=None, releases=None):
+        self.namespaces = namespaces or OrderedDict()
+        self.vms = vms or OrderedDict()
+        self.releases = releases or OrderedDict()
+
+    @staticmethod
+    def add(resources, build_num, name):
+        resources.setdefault(build_num, []).append(name)
+
+    @staticmethod
+    def names(resources, build_nums):
+        return sorted(
+            name for build_num in build_nums for name in resources.get(build_num, [])
+        )
+
+
+class NameMatcher():
+    """
+    Classifies namespace, helm release and vm names by prefix and build
+    number. The patterns for every prefix are compiled once into a single
+    expression per resource type, so each name is matched exactly once.
+    When prefixes overlap the longest one wins, e.g. with test and foo-test
+    the release web-foo-test-1 belongs to foo-test.
+    """
+    IGNORED_NAMESPACES = ['default', 'kube-system', 'kube-public']
+
+    def __init__(self, prefixes):
+        self.prefixes = list(prefixes)
+        alternation = '|'.join(
+            re.escape(prefix) for prefix in sorted(self.prefixes, key=len, reverse=True))
+        self.namespace_regex = re.compile(r'^({})-(\d+)$'.format(alternation))
+        # lazy so the release name is split at its first possible prefix
+        self.release_regex = re.compile(r'^\S*?-({})-(\d+)$'.format(alternation))
+        self.vm_regex = re.compile(r'^condor-({})-(\d+)$'.format(alternation))
+
+    def namespace(self, name):
+        if name in self.IGNORED_NAMESPACES:
+            return None, None
+        return self._match(self.namespace_regex, name, 'namespace')
+
+    def release(self, name):
+        return self._match(self.release_regex, name, 'release')
+
+    def vm(self, name):
+        return self._match(self.vm_regex, name, 'vm')
+
+    def classify(self, match, names):
+        """
+        Args:
+        match (function): namespace, release or vm
+        names (list): resource names
+
+        Returns:
+        (dict): prefix to OrderedDict of build number to names
+        """
+        resources = dict((prefix, OrderedDict()) for prefix in self.prefixes)
+        for name in names:
+            prefix, build_num = match(name)
+            if prefix is not None:
+                Inventory.add(resources[prefix], build_num, name)
+        return resources
+
+    @staticmethod
+    def _match(regex, name, kind):
+        match = regex.match(name)
+        if match is None:
+            logging.debug("Unexpected {} found: {}".format(kind, name))
+            return None, None
+        return match.group(1), match.group(2)
+
+
+class DeleteExecutor():
+    """
+    Runs delete commands for many objects. Objects are appended to their
+    command in chunks of at most chunk_size, to stay clear of the argument
+    length limit, and the chunks of every command run concurrently on
+    workers threads. When a chunk fails each of its objects is retried on
+    its own so the outcome of every object is known. The delete commands
+    still delete the objects of a failed chunk that they can, so a retry
+    that reports exactly its object as not found counts it as deleted.
+    Backends that are called instead decide this for their own objects.
+    """
+    def __init__(self, noop, chunk_size=50, workers=4):
+        self.noop = noop
+        self.chunk_size = chunk_size
+        self.workers = workers
+
+    def run(self, jobs):
+        """
+        Args:
+        jobs (list): (cmd, objs) tuples, objs are appended to cmd when it
+        is a command line, otherwise cmd is called with a chunk of objs
+
+        Returns:
+        (OrderedDict): object to 'deleted', 'failed' or 'noop'
+        """
+        chunks = []
+        for cmd, objs in jobs:
+            objs = list(objs)
+            for i in range(0, len(objs), self.chunk_size):
+                chunks.append((cmd, objs[i:i + self.chunk_size]))
+
+        results = OrderedDict()
+        for result in parallel_map(self._run_chunk, chunks, self.workers):
+            results.update(result)
+        return results
+
+    def _run_chunk(self, chunk):
+        cmd, objs = chunk
+        try:
+            if isinstance(cmd, list):
+                full_cmd = cmd + objs
+                logging.info("Running delete command: {}".format(full_cmd))
+                if self.noop is not False:
+                    return [(obj, 'noop') for obj in objs]
+                delete_out = subprocess.check_output(full_cmd, stderr=subprocess.STDOUT)
+                logging.info(delete_out)
+            else:
+                logging.info("Running {}: {}".format(cmd.__name__, objs))
+                if self.noop is not False:
+                    return [(obj, 'noop') for obj in objs]
+                cmd(objs)
+            return [(obj, 'deleted') for obj in objs]
+        except (subprocess.CalledProcessError, KubernetesApiError, ComputeApiError) as exc:
+            output = getattr(exc, 'output', None) or ''
+            if len(objs) == 1 and NOT_FOUND.format(objs[0]) in output:
+                logging.info("{} is already gone".format(objs[0]))
+                return [(objs[0], 'deleted')]
+            logging.error("Delete command failed: {} {}".format(exc, output))
+            if len(objs) == 1:
+                return [(objs[0], 'failed')]
+        results = []
+        for obj in objs:
+            results.extend(self._run_chunk((cmd, [obj])))
+        return results
 
 
 class NamespaceGC():
-    def __init__(self, noop, prefix='circleci'):
+    def __init__(self, noop, prefix='circleci', chunk_size=50, workers=4,
+                 kubernetes=None, compute=None, state=None):
         self.circleci = CircleCIBase()
+        self.state = state
+        if kubernetes is None:
+            kubernetes = KubectlBackend()
+        self.kubernetes = kubernetes
+        if compute is None:
+            compute = GcloudBackend()
+        self.compute = compute
         self.noop = noop
         self.prefix=prefix
+        self.matchers = {}
+        self.executor = DeleteExecutor(noop, chunk_size=chunk_size, workers=workers)
 
-    def get_active_namespaces(self):
-        active_namespaces = []
-        ns_out = subprocess.check_output(["kubectl", "get", "ns"])
-        ignore = ['default', 'kube-system', 'kube-public']
-        for line in ns_out.rstrip().split("\n")[1:]:
-            spl_line = line.split()
-            if spl_line[1] == 'Active':
-                name = spl_line[0]
-                if name not in ignore:
-                    match = re.search('^{}-(\d+)$'.format(self.prefix), name)
-                    if match:
-                        active_namespaces.append(match.group(1))
-                    else:
-                        logging.debug(
-                            "Found unexpected namespace: {}".format(name)
-                        )
-        return active_namespaces
+    def matcher(self, prefixes=None):
+        # compiled once per set of prefixes
+        key = tuple(sorted(prefixes or [self.prefix]))
+        if key not in self.matchers:
+            self.matchers[key] = NameMatcher(key)
+        return self.matchers[key]
 
-    def get_active_vms(self):
-        cmd = [
-            'gcloud',
-            'compute',
-            'instances',
-            'list',
-            '--filter',
-            "name:(condor-{}-*)".format(self.prefix),
-            "--format=json(name)"
-        ]
-        logging.debug(" ".join(cmd))
-        vm_out = subprocess.check_output(cmd)
-        vm_names = [
-            str(
-                x['name'].strip('condor-{}-'.format(self.prefix))
-            ) for x in json.loads(vm_out)
-        ]
-        return vm_names
+    def namespace_build_num(self, name, prefixes=None):
+        return self.matcher(prefixes).namespace(name)[1]
 
-    def get_active_helm_releases(self):
-        cmd = [
-            'helm',
-            'list',
-            '-q',
-        ]
-        logging.debug(" ".join(cmd))
-        vm_out = subprocess.check_output(cmd)
-        build_nums = set()
-        for release in vm_out.split():
-            match = re.search('^\S*-{}-(\d+)$'.format(self.prefix), release)
-            if match:
-                build_nums.add(match.group(1))
-            else:
-                logging.debug("Unexpected release found: {}".format(release))
-        # this has lots of dups, but it gets converted to a set later
-        return list(build_nums)
+    def list_namespaces(self, prefixes=None):
+        return self._one(self._list_namespaces, prefixes)
 
-    # get up to the last 30 builds that are active, you can
-    # also filter the results to return a single key
-    def get_active_builds(self, repo, filter=None):
-        builds = self.circleci.get_build_status(repo)
-        if isinstance(builds, list):
-            if filter is not None:
-                builds = [str(x[filter]) for x in builds]
-            return builds
-        else:
-            logging.error("Unexpected type for data: {}".format(builds))
-            exit(1)
+    def _list_namespaces(self, prefixes):
+        return self.matcher(prefixes).classify(
+            self.matcher(prefixes).namespace, self.kubernetes.list_namespaces())
 
-    def _run_gcloud_vm_delete_cmd(self, build_nums=[]):
-        self._run_delete_cmd(
-            "condor-{}-".format(self.prefix),
-            [
-                "gcloud",
-                "compute",
-                "instances",
-                "delete",
-                "--zone=us-west1-b",
-                "--quiet"
-            ],
-            build_nums,
-        )
+    def list_vms(self, prefixes=None):
+        return self._one(self._list_vms, prefixes)
 
-    def _run_gc_ns_delete_cmd(self, build_nums=[]):
-        self._run_delete_cmd(
-            "{}-".format(self.prefix),
-            ["kubectl", "delete", "ns"],
-            build_nums,
-        )
+    def _list_vms(self, prefixes):
+        return self.matcher(prefixes).classify(
+            self.matcher(prefixes).vm, self.compute.list_vms(prefixes))
+
+    def list_helm_releases(self, prefixes=None):
+        return self._one(self._list_helm_releases, prefixes)
 
-    def _run_helm_delete_cmd(self, build_nums=[]):
+    def _list_helm_releases(self, prefixes):
         cmd = [
             'helm',
             'list',
@@ -109,48 +212,392 @@ class NamespaceGC():
         ]
         logging.debug(" ".join(cmd))
         helm_list_out = subprocess.check_output(cmd)
-        releases_to_delete = []
-        for release in helm_list_out.split():
-            match = re.search('^\S*-{}-(\d+)$'.format(self.prefix), release)
-            if match:
-                if match.group(1) in build_nums:
-                    releases_to_delete.append(release)
-        self._run_delete_cmd(
-            '',
-            ["helm", "delete", "--purge"],
-            releases_to_delete,
+        return self.matcher(prefixes).classify(
+            self.matcher(prefixes).release, helm_list_out.split())
+
+    def get_active_namespaces(self):
+        return list(self.list_namespaces())
+
+    def get_active_vms(self):
+        return list(self.list_vms())
+
+    def get_active_helm_releases(self):
+        return list(self.list_helm_releases())
+
+    def take_inventory(self):
+        return self.take_inventories([self.prefix])[self.prefix]
+
+    def take_inventories(self, prefixes):
+        """
+        Lists namespaces, vms and helm releases once and splits them by
+        prefix.
+
+        Returns:
+        (dict): prefix to Inventory
+        """
+        # the listings are independent, so run them concurrently
+        namespaces, vms, releases = parallel_map(
+            lambda list_resources: list_resources(prefixes),
+            [
+                self._list_namespaces,
+                self._list_vms,
+                self._list_helm_releases,
+            ]
+        )
+        return dict(
+            (prefix, Inventory(
+                namespaces=namespaces[prefix],
+                vms=vms[prefix],
+                releases=releases[prefix],
+            )) for prefix in prefixes
         )
 
-    def _run_delete_cmd(self, prefix, cmd, build_nums=[]):
-        munged_objs = ['{}{}'.format(prefix, i) for i in build_nums]
-        if len(munged_objs) > 0:
-            cmd.extend(munged_objs)
-            logging.info("Running delete command: {}".format(cmd))
-            if self.noop is False:
-                delete_out = subprocess.check_output(cmd)
-                logging.info(delete_out)
+    def _one(self, list_resources, prefixes):
+        # public listings return the resources of the first prefix
+        prefixes = prefixes or [self.prefix]
+        return list_resources(prefixes)[prefixes[0]]
+
+    # get every build that is active, you can
+    # also filter the results to return a single key. returns None when the
+    # builds can not be listed, this runs on pool threads where exiting
+    # would hang the pool.
+    def get_active_builds(self, repo, filter=None):
+        try:
+            if filter is not None:
+                return [str(x[filter]) for x in self.circleci.iter_builds(repo)]
+            return list(self.circleci.iter_builds(repo))
+        except ValueError as exc:
+            logging.error(exc)
+            return None
+
+    def _run_gcloud_vm_delete_cmd(self, vms=[]):
+        return self._run_delete_cmd(self.compute.vm_deleter(), vms)
+
+    def _run_gc_ns_delete_cmd(self, namespaces=[]):
+        return self._run_delete_cmd(self.kubernetes.namespace_deleter(), namespaces)
+
+    def _run_helm_delete_cmd(self, releases=[]):
+        return self._run_delete_cmd(HELM_DELETE_CMD, releases)
+
+    def _run_delete_cmd(self, cmd, objs=[]):
+        return self.executor.run([(cmd, objs)])
 
     def gc_builds(self, repo):
+        return self.gc_repos(OrderedDict([(repo, self.prefix)]))
+
+    def gc_repos(self, repos):
+        """
+        Collects garbage for several repos sharing a cluster in one pass:
+        resources are listed once for all prefixes and the running builds of
+        every repo are fetched concurrently.
+
+        Args:
+        repos (dict): github org/repo to resource prefix
+        """
+        prefixes = sorted(set(repos.values()))
         # you have to get ns first b/c otherwise, you could delete builds that
-        # are created before ns is called
-        active_ns = self.get_active_namespaces()
-        active_builds = self.get_active_builds(repo, filter='build_num')
-        active_vms = self.get_active_vms()
-        active_helm_releases = self.get_active_helm_releases()
-        ns_to_gc = list(set(active_ns) - set(active_builds))
-        vms_to_gc = list(set(active_vms) - set(active_builds))
-        releases_to_gc = list(set(active_helm_releases) - set(active_builds))
+        # are created before ns is called. the same goes for vms and helm
+        # releases, so the active builds are only fetched once the whole
+        # inventory has been taken.
+        inventories = self.take_inventories(prefixes)
+        repo_builds = parallel_map(
+            lambda repo: self.get_active_builds(repo, filter='build_num'),
+            list(repos)
+        )
+        failed = [repo for repo, builds in zip(repos, repo_builds) if builds is None]
+        if failed:
+            # without the running builds everything would look like garbage
+            logging.error("Unable to list running builds for {}, nothing deleted".format(failed))
+            sys.exit(1)
+        # repos sharing a prefix share build numbers
+        active_builds = dict((prefix, set()) for prefix in prefixes)
+        for repo, builds in zip(repos, repo_builds):
+            active_builds[repos[repo]].update(builds)
+
+        self.reconcile(*[inventories[prefix] for prefix in prefixes])
+        return self.delete([
+            self.finished_garbage(
+                self.garbage(inventories[prefix], active_builds[prefix]),
+                [repo for repo in repos if repos[repo] == prefix])
+            for prefix in prefixes
+        ])
+
+    def finished_garbage(self, garbage, repos):
+        """
+        Keeps only the garbage of builds that really finished. A running build
+        is missing from the listing when builds finish while it is paged, so
+        every candidate is looked up on its own before anything is deleted.
+
+        Args:
+        garbage (Inventory): objects of builds missing from the running builds
+        repos (list): github org/repos sharing the build numbers
+
+        Returns:
+        (Inventory): objects of builds finished in a repo and running in none
+        """
+        build_nums = sorted(set(garbage.namespaces) | set(garbage.vms) | set(garbage.releases))
+        lookups = [(repo, build_num) for build_num in build_nums for repo in repos]
+        builds = parallel_map(
+            lambda lookup: self.circleci.get_single_build_status(*lookup), lookups)
+        finished = set()
+        running = set()
+        for (repo, build_num), build in zip(lookups, builds):
+            # unknown builds are kept, the lookup may just have failed
+            if build is None:
+                continue
+            if build.get('lifecycle') == 'finished':
+                finished.add(build_num)
+            else:
+                running.add(build_num)
+        unfinished = set(build_nums) - (finished - running)
+        if unfinished:
+            logging.warning("Builds not confirmed finished, kept: {}".format(sorted(unfinished)))
+        return Inventory(
+            namespaces=OrderedDict((k, v) for k, v in garbage.namespaces.items() if k not in unfinished),
+            vms=OrderedDict((k, v) for k, v in garbage.vms.items() if k not in unfinished),
+            releases=OrderedDict((k, v) for k, v in garbage.releases.items() if k not in unfinished),
+        )
+
+    def reconcile(self, *inventories):
+        # a full inventory tells the state store which objects are gone
+        if self.state is not None:
+            for kind, attr in [('release', 'releases'), ('namespace', 'namespaces'), ('vm', 'vms')]:
+                resources = OrderedDict()
+                for inventory in inventories:
+                    for build_num, names in getattr(inventory, attr).items():
+                        resources.setdefault(build_num, []).extend(names)
+                self.state.reconcile(kind, resources)
+
+    def collect(self, inventory, active_builds):
+        return self.delete([self.garbage(inventory, active_builds)])
+
+    def garbage(self, inventory, active_builds):
+        ns_to_gc = list(set(inventory.namespaces) - set(active_builds))
+        vms_to_gc = list(set(inventory.vms) - set(active_builds))
+        releases_to_gc = list(set(inventory.releases) - set(active_builds))
         logging.debug("Active builds: {}".format(active_builds))
-        logging.debug("Active helm: {}".format(set(active_helm_releases)))
-        logging.debug("Active VMs: {}".format(active_vms))
-        logging.debug("Active namespaces: {}".format(active_ns))
+        logging.debug("Active helm: {}".format(list(inventory.releases)))
+        logging.debug("Active VMs: {}".format(list(inventory.vms)))
+        logging.debug("Active namespaces: {}".format(list(inventory.namespaces)))
         logging.debug("NS to GC:{}".format(ns_to_gc))
         logging.debug("VMs to GC:{}".format(vms_to_gc))
         logging.debug("Releases to GC:{}".format(releases_to_gc))
+        return Inventory(
+            namespaces=OrderedDict((k, inventory.namespaces[k]) for k in ns_to_gc),
+            vms=OrderedDict((k, inventory.vms[k]) for k in vms_to_gc),
+            releases=OrderedDict((k, inventory.releases[k]) for k in releases_to_gc),
+        )
+
+    def delete(self, garbage):
+        """
+        Deletes everything in the given inventories with one executor run.
 
-        self._run_helm_delete_cmd(releases_to_gc)
-        self._run_gc_ns_delete_cmd(ns_to_gc)
-        self._run_gcloud_vm_delete_cmd(vms_to_gc)
+        Returns:
+        (OrderedDict): object to 'deleted', 'failed' or 'noop'
+        """
+        targets = []
+        for kind, cmd, attr in [
+                ('release', HELM_DELETE_CMD, 'releases'),
+                ('namespace', self.kubernetes.namespace_deleter(), 'namespaces'),
+                ('vm', self.compute.vm_deleter(), 'vms')]:
+            names = []
+            for inventory in garbage:
+                resources = getattr(inventory, attr)
+                names.extend(Inventory.names(resources, list(resources)))
+            targets.append((kind, cmd, names))
+        if self.state is not None:
+            targets = [
+                (kind, cmd, self._skip_pending(kind, names))
+                for kind, cmd, names in targets
+            ]
+        results = self.executor.run([(cmd, names) for kind, cmd, names in targets])
+        if self.state is not None:
+            for kind, cmd, names in targets:
+                self.state.record_deletions(
+                    kind, dict((name, results[name]) for name in names))
+        failed = [obj for obj, result in results.items() if result == 'failed']
+        if failed:
+            logging.error("Failed to delete: {}".format(failed))
+        return results
+
+    def _skip_pending(self, kind, names):
+        pending = self.state.pending(kind)
+        skipped = [name for name in names if name in pending]
+        if skipped:
+            logging.info("Deletion already requested for: {}".format(skipped))
+        return [name for name in names if name not in pending]
+
+
+DAEMON_ERRORS = (
+    subprocess.CalledProcessError,
+    KubernetesApiError,
+    ComputeApiError,
+    requests.RequestException,
+    ValueError,
+)
+
+
+class NamespaceGCDaemon():
+    """
+    Keeps an index of build number to namespaces, vms and helm releases and
+    reclaims a build's resources as soon as the build is seen to finish,
+    instead of rescanning everything on every run.
+
+    Running builds are polled every poll_interval seconds. With the
+    kubernetes api backend the namespace index is kept current from a watch,
+    vms and helm releases (and namespaces with kubectl) are only listed
+    again when a build finishes. Every resync_interval seconds a full gc
+    pass catches builds that started and finished between polls.
+    """
+    def __init__(self, gc, repo, poll_interval=15, resync_interval=600):
+        self.gc = gc
+        self.repo = repo
+        self.poll_interval = poll_interval
+        self.resync_interval = resync_interval
+        self.inventory = Inventory()
+        self.running = set()
+        self.watching = False
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+
+    def run(self):
+        synced = self.attempt(self.resync)
+        last_resync = time.time()
+        if hasattr(self.gc.kubernetes, 'watch_namespaces'):
+            self.watching = True
+            watcher = threading.Thread(target=self.watch_namespaces)
+            watcher.daemon = True
+            watcher.start()
+        while not self.stopped.wait(self.poll_interval):
+            # a failed resync is retried on the next tick, the index can not
+            # be trusted until one succeeds
+            if not synced or time.time() - last_resync >= self.resync_interval:
+                synced = self.attempt(self.resync)
+                last_resync = time.time()
+            else:
+                self.attempt(self.poll_builds)
+
+    @staticmethod
+    def attempt(step):
+        # the daemon outlives transient failures of kubectl, helm, gcloud
+        # and the apis, the next resync catches up on anything missed
+        try:
+            return step() is not False
+        except DAEMON_ERRORS as exc:
+            logging.error("{} failed: {}".format(step.__name__, exc))
+            return False
+
+    def stop(self):
+        self.stopped.set()
+
+    def resync(self):
+        inventory = self.gc.take_inventory()
+        running = self.running_builds()
+        if running is None:
+            return False
+        self.gc.reconcile(inventory)
+        self.gc.collect(inventory, running)
+        with self.lock:
+            self.running = running
+            self.inventory = Inventory(
+                namespaces=self._only(inventory.namespaces, running),
+                vms=self._only(inventory.vms, running),
+                releases=self._only(inventory.releases, running),
+            )
+
+    def running_builds(self):
+        try:
+            return set(str(x['build_num']) for x in self.gc.circleci.iter_builds(self.repo))
+        except ValueError as exc:
+            logging.error(exc)
+            return None
+
+    def poll_builds(self):
+        running = self.running_builds()
+        if running is None:
+            return
+        with self.lock:
+            stopped = self.running - running
+            self.running = running
+        # a build can drop out of the running list while paging, so make
+        # sure it really finished before reclaiming anything
+        finished = [
+            build_num for build_num in stopped
+            if self.build_finished(build_num)
+        ]
+        with self.lock:
+            self.running.update(set(stopped) - set(finished))
+        if finished:
+            self.reclaim(finished)
+
+    def build_finished(self, build_num):
+        build = self.gc.circleci.get_single_build_status(self.repo, build_num)
+        return build is not None and build.get('lifecycle') == 'finished'
+
+    def reclaim(self, build_nums):
+        logging.info("Builds finished: {}".format(sorted(build_nums)))
+        # vms and helm releases can not be watched, so they are listed again
+        # now that there is something to reclaim
+        listings = [self.gc.list_vms, self.gc.list_helm_releases]
+        if not self.watching:
+            listings.append(self.gc.list_namespaces)
+        listed = parallel_map(lambda list_resources: list_resources(), listings)
+        with self.lock:
+            self.inventory.vms, self.inventory.releases = listed[0], listed[1]
+            if not self.watching:
+                self.inventory.namespaces = listed[2]
+            inventory = Inventory(
+                namespaces=self._pop(self.inventory.namespaces, build_nums),
+                vms=self._pop(self.inventory.vms, build_nums),
+                releases=self._pop(self.inventory.releases, build_nums),
+            )
+        return self.gc.collect(inventory, [])
+
+    def watch_namespaces(self):
+        while not self.stopped.is_set():
+            try:
+                for event, name, phase in self.gc.kubernetes.watch_namespaces():
+                    self.apply_namespace_event(event, name, phase)
+                    if self.stopped.is_set():
+                        return
+            except (KubernetesApiError, requests.RequestException) as exc:
+                logging.error(exc)
+                self.stopped.wait(self.poll_interval)
+                self.refresh_namespaces()
+
+    def refresh_namespaces(self):
+        # relisting also resets the watch resource version
+        try:
+            namespaces = self.gc.list_namespaces()
+        except (KubernetesApiError, requests.RequestException) as exc:
+            logging.error(exc)
+            return
+        with self.lock:
+            self.inventory.namespaces = namespaces
+
+    def apply_namespace_event(self, event, name, phase):
+        build_num = self.gc.namespace_build_num(name)
+        if build_num is None:
+            return
+        with self.lock:
+            names = self.inventory.namespaces.get(build_num, [])
+            if event in ('ADDED', 'MODIFIED') and phase == 'Active':
+                if name not in names:
+                    Inventory.add(self.inventory.namespaces, build_num, name)
+            elif name in names:
+                names.remove(name)
+                if not names:
+                    del self.inventory.namespaces[build_num]
+
+    @staticmethod
+    def _only(resources, build_nums):
+        return OrderedDict((k, v) for k, v in resources.items() if k in build_nums)
+
+    @staticmethod
+    def _pop(resources, build_nums):
+        return OrderedDict(
+            (k, resources.pop(k)) for k in build_nums if k in resources
+        )
 
 
 def arg_parser():
@@ -158,10 +605,42 @@ def arg_parser():
     p.add_argument('--noop', action='store_true', default=False)
     p.add_argument('--verbose', action='store_true', default=False)
     p.add_argument('--prefix', type=str, default='circleci')
-    p.add_argument('repo', type=str, help='github org/repo')
+    p.add_argument('--chunk-size', type=int, default=50,
+                   help='Max number of objects passed to one delete command')
+    p.add_argument('--workers', type=int, default=4,
+                   help='Number of delete commands run concurrently')
+    p.add_argument('--kubernetes-backend', choices=['kubectl', 'api'], default='kubectl',
+                   help='List and delete namespaces with kubectl or the kubernetes api')
+    p.add_argument('--label-selector', type=str, default=None,
+                   help='Only consider namespaces matching this label selector (api backend)')
+    p.add_argument('--compute-backend', choices=['gcloud', 'api'], default='gcloud',
+                   help='List and delete vms with gcloud or the compute api')
+    p.add_argument('--daemon', action='store_true', default=False,
+                   help='Keep running and reclaim resources as builds finish')
+    p.add_argument('--poll-interval', type=int, default=15,
+                   help='Seconds between polls of running builds (daemon)')
+    p.add_argument('--resync-interval', type=int, default=600,
+                   help='Seconds between full gc passes (daemon)')
+    p.add_argument('--state-file', type=str, default=None,
+                   help='SQLite file remembering deletions between runs')
+    p.add_argument('--retry-after', type=int, default=RETRY_AFTER,
+                   help='Seconds before a pending deletion is requested again')
+    p.add_argument('repo', type=str, nargs='+',
+                   help='github org/repo, or org/repo:prefix to override --prefix')
     return p.parse_args()
 
 
+def parse_repos(repos, default_prefix):
+    result = OrderedDict()
+    for repo in repos:
+        if ':' in repo:
+            repo, prefix = repo.split(':', 1)
+        else:
+            prefix = default_prefix
+        result[repo] = prefix
+    return result
+
+
 def init_logger(level=logging.INFO):
     root = logging.getLogger()
     root.setLevel(level)
@@ -175,5 +654,27 @@ def cli():
         init_logger(level=logging.DEBUG)
     else:
         init_logger(level=logging.INFO)
-    gc = NamespaceGC(args.noop, prefix=args.prefix)
-    gc.gc_builds(args.repo)
+    kubernetes = None
+    if args.kubernetes_backend == 'api':
+        kubernetes = KubernetesApiBackend.from_environment(label_selector=args.label_selector)
+    compute = None
+    if args.compute_backend == 'api':
+        compute = ComputeApiBackend.from_environment()
+    state = None
+    if args.state_file is not None:
+        state = GCStateStore(args.state_file, retry_after=args.retry_after)
+    repos = parse_repos(args.repo, args.prefix)
+    if args.daemon:
+        if len(repos) != 1:
+            raise Exception('--daemon takes a single repo')
+        repo, prefix = list(repos.items())[0]
+        gc = NamespaceGC(args.noop, prefix=prefix,
+                         chunk_size=args.chunk_size, workers=args.workers,
+                         kubernetes=kubernetes, compute=compute, state=state)
+        NamespaceGCDaemon(gc, repo, poll_interval=args.poll_interval,
+                          resync_interval=args.resync_interval).run()
+    else:
+        gc = NamespaceGC(args.noop, prefix=args.prefix,
+                         chunk_size=args.chunk_size, workers=args.workers,
+                         kubernetes=kubernetes, compute=compute, state=state)
+        gc.gc_repos(repos)
@@ -0,0 +1,70 @@
+import inspect
+import os
+import threading
+from multiprocessing.pool import ThreadPool
+
+DEFAULT_CONCURRENCY = int(os.environ.get('CIRCLECI_CONCURRENCY', 8))
+
+_lock = threading.Lock()
+_pool = None
+
+
+def parallel_map(func, items, concurrency=None):
+    """
+    Calls func on every item using a bounded pool of threads. Results are
+    returned in the same order as items and the first exception raised by
+    func is re-raised in the caller.
+
+    Args:
+    func (function): function taking a single item
+    items (list): items to process
+    concurrency (int): max number of concurrent calls
+
+    Returns:
+    (list): results of func for each item
+    """
+    items = list(items)
+    if concurrency is None:
+        concurrency = DEFAULT_CONCURRENCY
+    concurrency = min(concurrency, len(items))
+    if concurrency <= 1:
+        return [func(item) for item in items]
+
+    pool = ThreadPool(concurrency)
+    try:
+        return pool.map(func, items)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def get_pool():
+    # the pool is shared so async clients overlap their requests without
+    # each starting threads of their own
+    global _pool
+    with _lock:
+        if _pool is None:
+            _pool = ThreadPool(DEFAULT_CONCURRENCY)
+        return _pool
+
+
+class AsyncClient():
+    """
+    Runs the methods of a client on the shared pool. Every method of the
+    wrapped client is available with the same arguments and returns an
+    AsyncResult, call get() on it for the result. Generator methods are
+    consumed into a list. Other attributes are returned as is.
+    """
+    def __init__(self, client):
+        self.client = client
+
+    def __getattr__(self, name):
+        attr = getattr(self.client, name)
+        if not callable(attr):
+            return attr
+
+        def call(*args, **kwargs):
+            if inspect.isgeneratorfunction(attr):
+                return get_pool().apply_async(lambda: list(attr(*args, **kwargs)))
+            return get_pool().apply_async(attr, args, kwargs)
+        return call
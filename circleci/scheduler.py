@@ -0,0 +1,124 @@
+import logging
+import os
+import random
+import threading
+import time
+import requests
+
+MAX_RETRIES = int(os.environ.get('CIRCLECI_MAX_RETRIES', 5))
+# start pacing requests once a token has fewer than this many calls left
+RATE_LIMIT_RESERVE = int(os.environ.get('CIRCLECI_RATE_LIMIT_RESERVE', 100))
+BACKOFF = 1.0
+MAX_BACKOFF = 60.0
+# longest we are willing to wait for a rate limit window to reset
+MAX_WAIT = 900.0
+
+_lock = threading.Lock()
+_scheduler = None
+
+
+class RequestScheduler():
+    """
+    Sends API requests on behalf of every client in the process. It tracks
+    the remaining rate limit quota per token from the X-RateLimit-* headers,
+    spreads the remaining calls over the time left in the window once the
+    quota runs low, and retries throttled and transient server errors with
+    jittered exponential backoff.
+    """
+    def __init__(self, max_retries=MAX_RETRIES, reserve=RATE_LIMIT_RESERVE,
+                 backoff=BACKOFF, max_backoff=MAX_BACKOFF, max_wait=MAX_WAIT):
+        self.max_retries = max_retries
+        self.reserve = reserve
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.max_wait = max_wait
+        self.quota = {}
+        self.lock = threading.Lock()
+
+    def send(self, key, verb, func, *args, **kwargs):
+        """
+        Calls func(*args, **kwargs) and returns its response, retrying when
+        the response is retryable.
+
+        Args:
+        key (string): identifies the quota the request is charged against
+        verb (string): http verb, only idempotent verbs retry server errors
+        func (function): function sending the request and returning a response
+        """
+        attempt = 0
+        while True:
+            self.pace(key)
+            try:
+                resp = func(*args, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as exc:
+                if verb != 'get' or attempt >= self.max_retries:
+                    raise
+                delay = self.backoff_delay(attempt)
+                logging.warning("Request failed ({}), retrying in {:.1f}s".format(exc, delay))
+            else:
+                self.update(key, resp)
+                delay = self.retry_delay(verb, resp, attempt)
+                if delay is None or attempt >= self.max_retries:
+                    return resp
+                logging.warning("Request returned {}, retrying in {:.1f}s".format(
+                    resp.status_code, delay))
+            time.sleep(delay)
+            attempt += 1
+
+    def update(self, key, resp):
+        remaining = resp.headers.get('X-RateLimit-Remaining')
+        reset = resp.headers.get('X-RateLimit-Reset')
+        if remaining is None or reset is None:
+            return
+        with self.lock:
+            self.quota[key] = (int(remaining), float(reset))
+
+    def pace(self, key):
+        with self.lock:
+            quota = self.quota.get(key)
+        if quota is None:
+            return
+        remaining, reset = quota
+        window = reset - time.time()
+        if window <= 0 or remaining > self.reserve:
+            return
+        # spread what is left of the quota over what is left of the window
+        delay = min(window / max(remaining, 1), self.max_wait)
+        logging.info("{} requests left before rate limit reset, waiting {:.1f}s".format(
+            remaining, delay))
+        time.sleep(delay)
+
+    def retry_delay(self, verb, resp, attempt):
+        status = resp.status_code
+        remaining = resp.headers.get('X-RateLimit-Remaining')
+        throttled = status == 429 or (
+            status == 403 and (remaining == '0' or 'Retry-After' in resp.headers))
+        # a 5xx on a post may still have been processed, so only requests
+        # that are safe to repeat are retried
+        transient = 500 <= status < 600 and verb == 'get'
+        if not (throttled or transient):
+            return None
+
+        retry_after = resp.headers.get('Retry-After')
+        if retry_after is not None:
+            try:
+                return min(float(retry_after), self.max_wait)
+            except ValueError:
+                pass
+        reset = resp.headers.get('X-RateLimit-Reset')
+        if remaining == '0' and reset is not None:
+            return min(max(float(reset) - time.time(), 0) + random.uniform(0, 1), self.max_wait)
+        return self.backoff_delay(attempt)
+
+    def backoff_delay(self, attempt):
+        delay = min(float(self.backoff) * (2 ** attempt), self.max_backoff)
+        return random.uniform(delay / 2, delay)
+
+
+def get_scheduler():
+    # the scheduler is shared so quota is tracked across all clients
+    global _scheduler
+    with _lock:
+        if _scheduler is None:
+            _scheduler = RequestScheduler()
+        return _scheduler
@@ -0,0 +1,69 @@
+import os
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+
+# Number of per-host connection pools to keep around, how many connections
+# each host pool may hold, and whether a host pool blocks once it is full
+# instead of opening extra throwaway connections.
+POOL_CONNECTIONS = int(os.environ.get('CIRCLECI_POOL_CONNECTIONS', 4))
+POOL_MAXSIZE = int(os.environ.get('CIRCLECI_POOL_MAXSIZE', 10))
+POOL_BLOCK = os.environ.get('CIRCLECI_POOL_BLOCK', 'true').lower() == 'true'
+KEEP_ALIVE = os.environ.get('CIRCLECI_KEEP_ALIVE', 'true').lower() == 'true'
+
+_lock = threading.Lock()
+_session = None
+
+
+def create_session(pool_connections=None, pool_maxsize=None,
+                   pool_block=None, keep_alive=None):
+    """
+    Creates a requests session with a connection pool mounted for http and
+    https, so repeated API calls reuse warm TCP/TLS connections.
+
+    Args:
+    pool_connections (int): number of host pools to cache
+    pool_maxsize (int): max connections kept per host
+    pool_block (bool): block when a host pool is exhausted
+    keep_alive (bool): keep connections open between requests
+
+    Returns:
+    (requests.Session): configured session
+    """
+    if pool_connections is None:
+        pool_connections = POOL_CONNECTIONS
+    if pool_maxsize is None:
+        pool_maxsize = POOL_MAXSIZE
+    if pool_block is None:
+        pool_block = POOL_BLOCK
+    if keep_alive is None:
+        keep_alive = KEEP_ALIVE
+
+    session = requests.Session()
+    adapter = HTTPAdapter(
+        pool_connections=pool_connections,
+        pool_maxsize=pool_maxsize,
+        pool_block=pool_block,
+    )
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    if not keep_alive:
+        session.headers['Connection'] = 'close'
+    return session
+
+
+def get_session():
+    # the session is shared by every client in the process
+    global _session
+    with _lock:
+        if _session is None:
+            _session = create_session()
+        return _session
+
+
+def reset_session():
+    global _session
+    with _lock:
+        if _session is not None:
+            _session.close()
+        _session = None
@@ -0,0 +1,108 @@
+import sqlite3
+import threading
+import time
+
+RETRY_AFTER = 1800
+
+
+class GCStateStore():
+    """
+    SQLite record of the objects the namespace GC has seen, when it asked
+    for them to be deleted and how that went. Objects whose deletion was
+    requested recently are skipped on later runs while they are still
+    listed, e.g. vms and helm releases that are still being torn down,
+    until retry_after seconds have passed or the deletion failed.
+    Terminating namespaces are not listed, so their rows are dropped by the
+    next reconcile.
+    """
+    def __init__(self, path, retry_after=RETRY_AFTER):
+        self.path = path
+        self.retry_after = retry_after
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        with self.db:
+            self.db.execute(
+                'CREATE TABLE IF NOT EXISTS objects ('
+                ' kind TEXT NOT NULL,'
+                ' name TEXT NOT NULL,'
+                ' build_num TEXT,'
+                ' first_seen REAL,'
+                ' last_seen REAL,'
+                ' delete_requested REAL,'
+                ' outcome TEXT,'
+                ' PRIMARY KEY (kind, name))'
+            )
+
+    def close(self):
+        self.db.close()
+
+    def reconcile(self, kind, resources, now=None):
+        """
+        Records every object of kind found in a full listing and forgets the
+        ones that are gone, their deletion is complete.
+
+        Args:
+        kind (string): namespace, vm or release
+        resources (dict): build number to object names
+        """
+        if now is None:
+            now = time.time()
+        seen = [
+            (kind, name, build_num, now, now)
+            for build_num, names in resources.items() for name in names
+        ]
+        with self.lock, self.db:
+            self.db.execute('CREATE TEMP TABLE IF NOT EXISTS seen (name TEXT PRIMARY KEY)')
+            self.db.execute('DELETE FROM seen')
+            self.db.executemany(
+                'INSERT OR IGNORE INTO seen VALUES (?)', [(row[1],) for row in seen])
+            self.db.execute(
+                'DELETE FROM objects WHERE kind = ? AND name NOT IN (SELECT name FROM seen)',
+                (kind,))
+            self.db.executemany(
+                'INSERT OR IGNORE INTO objects (kind, name, build_num, first_seen, last_seen)'
+                ' VALUES (?, ?, ?, ?, ?)', seen)
+            self.db.execute(
+                'UPDATE objects SET last_seen = ? WHERE kind = ?', (now, kind))
+
+    def pending(self, kind, now=None):
+        # deletions still in flight, failed ones are retried right away
+        if now is None:
+            now = time.time()
+        with self.lock:
+            rows = self.db.execute(
+                'SELECT name FROM objects WHERE kind = ? AND delete_requested > ?'
+                ' AND outcome != ?', (kind, now - self.retry_after, 'failed')
+            ).fetchall()
+        return set(row[0] for row in rows)
+
+    def record_deletions(self, kind, outcomes, now=None):
+        """
+        Args:
+        kind (string): namespace, vm or release
+        outcomes (dict): object name to 'deleted', 'failed' or 'noop'
+        """
+        if now is None:
+            now = time.time()
+        rows = [
+            (kind, name, now, now, now, outcome)
+            for name, outcome in outcomes.items() if outcome != 'noop'
+        ]
+        with self.lock, self.db:
+            self.db.executemany(
+                'INSERT OR IGNORE INTO objects (kind, name, first_seen, last_seen, delete_requested, outcome)'
+                ' VALUES (?, ?, ?, ?, ?, ?)', rows)
+            self.db.executemany(
+                'UPDATE objects SET delete_requested = ?, outcome = ? WHERE kind = ? AND name = ?',
+                [(row[4], row[5], row[0], row[1]) for row in rows])
+
+    def get(self, kind, name):
+        with self.lock:
+            row = self.db.execute(
+                'SELECT build_num, first_seen, last_seen, delete_requested, outcome'
+                ' FROM objects WHERE kind = ? AND name = ?', (kind, name)
+            ).fetchone()
+        if row is None:
+            return None
+        return dict(zip(
+            ['build_num', 'first_seen', 'last_seen', 'delete_requested', 'outcome'], row))
@@ -0,0 +1,97 @@
+import os
+import unittest
+from mock import MagicMock, patch
+
+from circleci.base import AsyncCircleCIBase, CircleCIBase
+
+
+class TestCircleCIBase(unittest.TestCase):
+    def setUp(self):
+        os.environ['CIRCLE_TOKEN'] = 'CI_TOKEN'
+
+    def builds_page(self, url, **kwargs):
+        # serves 250 running builds, 4701 shows up on two pages as if a new
+        # build started while paging
+        params = dict(p.split('=') for p in url.split('?')[1].split('&'))
+        offset = int(params['offset'])
+        limit = int(params['limit'])
+        builds = [{'build_num': 4800 - i} for i in range(250)]
+        builds.insert(100, {'build_num': 4701})
+        resp = MagicMock(status_code=200, headers={})
+        resp.json.return_value = builds[offset:offset + limit]
+        return resp
+
+    @patch('requests.Session.get')
+    def test_get_build_status(self, req):
+        req.return_value = MagicMock(status_code=200, headers={})
+        CircleCIBase().get_build_status('org/repo', branch='master', offset=30)
+        self.assertEqual(
+            req.call_args[0][0],
+            'https://circleci.com/api/v1.1/project/github/org/repo/tree/master?filter=running&limit=30&offset=30'
+        )
+
+    @patch('requests.Session.get')
+    def test_iter_builds(self, req):
+        req.side_effect = self.builds_page
+        builds = list(CircleCIBase().iter_builds('org/repo', page_size=100))
+        self.assertEqual([b['build_num'] for b in builds], [4800 - i for i in range(250)])
+        self.assertEqual(req.call_count, 3)
+
+    @patch('requests.Session.get')
+    def test_iter_builds_build_finishes_while_paging(self, req):
+        builds = [{'build_num': 4800 - i} for i in range(250)]
+
+        def page(url, **kwargs):
+            params = dict(p.split('=') for p in url.split('?')[1].split('&'))
+            offset = int(params['offset'])
+            limit = int(params['limit'])
+            resp = MagicMock(status_code=200, headers={})
+            resp.json.return_value = builds[offset:offset + limit]
+            if offset == 0:
+                # 4795 and 4790 finish right after the first page is served,
+                # the rest of the list moves back by two
+                builds.remove({'build_num': 4795})
+                builds.remove({'build_num': 4790})
+            return resp
+
+        req.side_effect = page
+        seen = [b['build_num'] for b in CircleCIBase().iter_builds('org/repo', page_size=100)]
+        self.assertEqual(seen, [4800 - i for i in range(250)])
+
+    @patch('requests.Session.get')
+    def test_iter_builds_stops_early(self, req):
+        req.side_effect = self.builds_page
+        builds = CircleCIBase().iter_builds('org/repo', page_size=10)
+        self.assertEqual(next(builds)['build_num'], 4800)
+        builds.close()
+        # at most the current page and the prefetched one
+        self.assertTrue(req.call_count <= 2)
+
+    @patch('requests.Session.get')
+    def test_iter_builds_unexpected_data(self, req):
+        req.return_value = MagicMock(status_code=200, headers={})
+        req.return_value.json.return_value = {'message': 'Project not found'}
+        with self.assertRaises(ValueError):
+            list(CircleCIBase().iter_builds('org/repo'))
+
+    @patch('requests.Session.post')
+    def test_cancel_build(self, req):
+        req.return_value = MagicMock(status_code=200, headers={})
+        req.return_value.json.return_value = {'build_num': 4701, 'status': 'canceled'}
+        self.assertEqual(
+            CircleCIBase().cancel_build('org/repo', 4701),
+            {'build_num': 4701, 'status': 'canceled'}
+        )
+        self.assertEqual(
+            req.call_args[0][0],
+            'https://circleci.com/api/v1.1/project/github/org/repo/4701/cancel'
+        )
+
+    @patch('requests.Session.get')
+    def test_async(self, req):
+        req.side_effect = self.builds_page
+        circleci = AsyncCircleCIBase()
+        builds = circleci.iter_builds('org/repo')
+        status = circleci.get_build_status('org/repo', limit=10)
+        self.assertEqual(len(builds.get()), 250)
+        self.assertEqual([b['build_num'] for b in status.get()], [4800 - i for i in range(10)])
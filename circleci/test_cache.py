@@ -0,0 +1,70 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from circleci.cache import ResponseCache
+
+
+class ResponseMock():
+    def __init__(self, body, headers):
+        self.status_code = 200
+        self.body = body
+        self.headers = headers
+
+    def json(self):
+        return self.body
+
+
+class TestResponseCache(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.headers = {'Authorization': 'token GH_TOKEN'}
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_store_and_load(self):
+        cache = ResponseCache(self.path)
+        url = 'https://api.github.com/repos/octocat/Hello-World/pulls/1'
+        self.assertEqual(cache.load(url, self.headers), None)
+
+        cache.store(url, self.headers, ResponseMock({'state': 'open'}, {'ETag': '"abc"'}))
+        entry = cache.load(url, self.headers)
+        self.assertEqual(entry['body'], {'state': 'open'})
+        self.assertEqual(cache.conditional_headers(entry), {'If-None-Match': '"abc"'})
+
+        # a different token never sees another token's responses
+        self.assertEqual(cache.load(url, {'Authorization': 'token OTHER'}), None)
+        # a second cache on the same directory, e.g. another process
+        self.assertEqual(ResponseCache(self.path).load(url, self.headers)['body'], {'state': 'open'})
+        for name in os.listdir(self.path):
+            with open(os.path.join(self.path, name)) as f:
+                self.assertFalse('GH_TOKEN' in f.read())
+
+    def test_store_without_validators(self):
+        cache = ResponseCache(self.path)
+        url = 'https://api.github.com/repos/octocat/Hello-World/pulls/1'
+        cache.store(url, self.headers, ResponseMock({}, {}))
+        self.assertEqual(cache.load(url, self.headers), None)
+
+    def test_conditional_headers(self):
+        cache = ResponseCache(self.path)
+        self.assertEqual(
+            cache.conditional_headers({'etag': None, 'last_modified': 'Thu, 05 Jul 2012 15:31:30 GMT'}),
+            {'If-Modified-Since': 'Thu, 05 Jul 2012 15:31:30 GMT'}
+        )
+
+    def test_evict(self):
+        cache = ResponseCache(self.path, max_entries=2)
+        urls = ['https://api.github.com/repos/octocat/Hello-World/pulls/{}'.format(i) for i in range(3)]
+        for i, url in enumerate(urls[:2]):
+            cache.store(url, self.headers, ResponseMock({'n': i}, {'ETag': str(i)}))
+            os.utime(cache.entry_path(url, self.headers), (time.time() - 10 + i, time.time() - 10 + i))
+        # loading marks the oldest entry as recently used
+        cache.load(urls[0], self.headers)
+        cache.store(urls[2], self.headers, ResponseMock({'n': 2}, {'ETag': '2'}))
+        self.assertEqual(len(os.listdir(self.path)), 2)
+        self.assertEqual(cache.load(urls[1], self.headers), None)
+        self.assertEqual(cache.load(urls[0], self.headers)['body'], {'n': 0})
@@ -1,11 +1,17 @@
 import os
+import re
+import shutil
 import subprocess
+import tempfile
 import unittest
+import requests
 from mock import MagicMock, patch
-from circleci.namespace_gc import NamespaceGC
+from circleci.namespace_gc import DeleteExecutor, Inventory, NameMatcher, NamespaceGC, NamespaceGCDaemon, parse_repos
+from circleci.kubernetes import KubectlBackend
+from circleci.state import GCStateStore
 
 
-def subprocess_side_effect(arg):
+def subprocess_side_effect(arg, **kwargs):
     gcloud_list_cmd = [
         'gcloud',
         'compute',
@@ -13,7 +19,7 @@ def subprocess_side_effect(arg):
         'list',
         '--filter',
         "name:(condor-circleci-*)",
-        "--format=json(name)"
+        "--format=json(name,zone)"
     ]
     if arg == ["kubectl", "get", "ns"]:
         return TestCircleCINamespaceGC.get_ns_output
@@ -25,6 +31,17 @@ def subprocess_side_effect(arg):
         return "[]"
 
 
+def circleci_get(url, **kwargs):
+    # builds listed as running are 123 and 4701, any other build has finished
+    resp = MagicMock(status_code=200, headers={})
+    match = re.search(r'/(\d+)$', url)
+    if match:
+        resp.json.return_value = {'build_num': int(match.group(1)), 'lifecycle': 'finished'}
+    else:
+        resp.json.return_value = [{'build_num': '123'}, {'build_num': '4701'}]
+    return resp
+
+
 class TestCircleCINamespaceGC(unittest.TestCase):
     get_ns_output = """NAME            STATUS    AGE
 123             Active    19h
@@ -36,10 +53,12 @@ kube-system     Active    19d
 """
     get_vm_output = """[
   {
-    "name": "condor-circleci-4701"
+    "name": "condor-circleci-4701",
+    "zone": "https://www.googleapis.com/compute/v1/projects/ci/zones/us-west1-b"
   },
   {
-    "name": "condor-circleci-4702"
+    "name": "condor-circleci-4702",
+    "zone": "https://www.googleapis.com/compute/v1/projects/ci/zones/us-west1-b"
   }
 ]"""
     get_helm_output = """cloud-testing-circleci-4706
@@ -67,11 +86,12 @@ h-celery-circleci-4710
     class CircleCIGetMock():
         def __init__(self):
             self.status_code=200
+            self.headers = {}
         def json(self):
             return [{'build_num': '123'},
                     {'build_num': '4701'}]
 
-    @patch('requests.get', return_value=CircleCIGetMock())
+    @patch('requests.Session.get', return_value=CircleCIGetMock())
     def test_get_active_builds(self, patch1):
         gc = NamespaceGC(False)
         result = gc.get_active_builds('org/repo', filter='build_num')
@@ -98,13 +118,13 @@ h-celery-circleci-4710
             ['4701', '4702', '4705', '4706', '4707', '4710']
         )
 
-    @patch('requests.get', return_value=CircleCIGetMock())
+    @patch('requests.Session.get', side_effect=circleci_get)
     def test_gc_builds(self, get_patch):
         m1 = MagicMock(side_effect=subprocess_side_effect)
         subprocess.check_output = m1
         gc = NamespaceGC(False)
         gc.gc_builds('org/repo')
-        m1.assert_any_call(["kubectl", "delete", "ns", "circleci-4702"])
+        m1.assert_any_call(["kubectl", "delete", "ns", "circleci-4702"], stderr=subprocess.STDOUT)
         m1.assert_any_call(
             [
                 'helm',
@@ -116,7 +136,352 @@ h-celery-circleci-4710
                 'condor-service-circleci-4705',
                 'h-celery-circleci-4705',
                 'h-celery-circleci-4710'
-            ]
+            ],
+            stderr=subprocess.STDOUT
+        )
+        m1.assert_any_call(["kubectl", "delete", "ns", "circleci-4702"], stderr=subprocess.STDOUT)
+        m1.assert_any_call(['gcloud', 'compute', 'instances', 'delete', '--quiet', '--zone=us-west1-b', 'condor-circleci-4702'], stderr=subprocess.STDOUT)
+        # the inventory is taken once per pass
+        self.assertEqual(
+            [c for c in m1.call_args_list if c[0][0] == ['helm', 'list', '-q']],
+            [((['helm', 'list', '-q'],), {})]
+        )
+
+    def test_take_inventory(self):
+        subprocess.check_output = MagicMock(side_effect=subprocess_side_effect)
+        inventory = NamespaceGC(False).take_inventory()
+        self.assertEqual(
+            inventory.namespaces,
+            {'4701': ['circleci-4701'], '4702': ['circleci-4702']}
+        )
+        self.assertEqual(
+            inventory.vms,
+            {'4701': ['condor-circleci-4701'], '4702': ['condor-circleci-4702']}
+        )
+        self.assertEqual(
+            inventory.releases['4705'],
+            ['condor-service-circleci-4705', 'h-celery-circleci-4705']
+        )
+        self.assertEqual(
+            Inventory.names(inventory.releases, ['4710', '4702']),
+            ['condor-service-circleci-4702', 'h-celery-circleci-4710']
+        )
+
+    @patch('requests.Session.get', side_effect=circleci_get)
+    def test_gc_builds_with_state(self, get_patch):
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        m1 = MagicMock(side_effect=subprocess_side_effect)
+        subprocess.check_output = m1
+        gc = NamespaceGC(False, state=GCStateStore(os.path.join(path, 'gc.db')))
+        results = gc.gc_builds('org/repo')
+        self.assertEqual(results['circleci-4702'], 'deleted')
+
+        # the namespace is terminating and no longer listed, the vm and the
+        # releases are still being torn down so they are skipped
+        def still_listed(arg, **kwargs):
+            if arg == ["kubectl", "get", "ns"]:
+                return self.get_ns_output.replace('circleci-4702   Active', 'circleci-4702   Terminating')
+            return subprocess_side_effect(arg, **kwargs)
+        m1 = MagicMock(side_effect=still_listed)
+        subprocess.check_output = m1
+        results = gc.gc_builds('org/repo')
+        self.assertEqual(results, {})
+        self.assertFalse(
+            [c for c in m1.call_args_list if 'delete' in c[0][0]]
+        )
+        self.assertIsNone(gc.state.get('namespace', 'circleci-4702'))
+        self.assertEqual(gc.state.get('vm', 'condor-circleci-4702')['outcome'], 'deleted')
+        self.assertEqual(gc.state.get('release', 'h-celery-circleci-4710')['outcome'], 'deleted')
+
+    @patch('requests.Session.get', side_effect=circleci_get)
+    def test_gc_repos(self, get_patch):
+        def side_effect(arg, **kwargs):
+            if arg == ["kubectl", "get", "ns"]:
+                return self.get_ns_output + "test-12         Active    1m\ntest-123        Active    1m\n"
+            elif arg == ['helm', 'list', '-q']:
+                return self.get_helm_output + "web-test-12\nweb-test-123\n"
+            elif arg[:4] == ['gcloud', 'compute', 'instances', 'list']:
+                self.assertEqual(arg[5], "name:(condor-circleci-* condor-test-*)")
+                return '[{"name": "condor-circleci-4702", "zone": "us-west1-b"}, {"name": "condor-test-12", "zone": "us-east1-c"}]'
+            return ''
+        m1 = MagicMock(side_effect=side_effect)
+        subprocess.check_output = m1
+        gc = NamespaceGC(False)
+        results = gc.gc_repos(parse_repos(['org/repo', 'org/other:test'], 'circleci'))
+        # one listing of each source for both prefixes
+        self.assertEqual(
+            len([c for c in m1.call_args_list if c[0][0] == ['helm', 'list', '-q']]), 1)
+        self.assertEqual(
+            len([c for c in m1.call_args_list if c[0][0] == ['kubectl', 'get', 'ns']]), 1)
+        # one listing of the running builds per repo
+        self.assertEqual(
+            len([c for c in get_patch.call_args_list if '?filter=running' in c[0][0]]), 2)
+        self.assertEqual(
+            sorted(results),
+            sorted([
+                'circleci-4702', 'test-12', 'condor-circleci-4702', 'condor-test-12',
+                'web-test-12', 'cloud-testing-circleci-4706', 'cloud-testing-circleci-4707',
+                'condor-service-circleci-4702', 'condor-service-circleci-4705',
+                'h-celery-circleci-4705', 'h-celery-circleci-4710',
+            ])
+        )
+
+    @patch('subprocess.check_output', side_effect=subprocess_side_effect)
+    def test_gc_repos_checks_candidates(self, check_output):
+        gc = NamespaceGC(False)
+        # 4702 moved between pages while the running builds were listed
+        gc.circleci.iter_builds = MagicMock(return_value=iter([{'build_num': '4701'}]))
+        lifecycles = {'4702': 'running', '4705': 'finished', '4706': 'finished', '4710': 'finished'}
+
+        def get_single_build_status(repo, build_num):
+            if build_num not in lifecycles:
+                return None
+            return {'build_num': int(build_num), 'lifecycle': lifecycles[build_num]}
+        gc.circleci.get_single_build_status = MagicMock(side_effect=get_single_build_status)
+        results = gc.gc_builds('org/repo')
+        self.assertEqual(
+            sorted(results),
+            ['cloud-testing-circleci-4706', 'condor-service-circleci-4705',
+             'h-celery-circleci-4705', 'h-celery-circleci-4710']
+        )
+        gc.circleci.get_single_build_status.assert_any_call('org/repo', '4702')
+
+    def test_gc_repos_build_listing_fails(self):
+        m1 = MagicMock(side_effect=subprocess_side_effect)
+        subprocess.check_output = m1
+        gc = NamespaceGC(False)
+
+        def iter_builds(repo):
+            if repo == 'org/b':
+                raise ValueError('Unexpected type for data')
+            return iter([{'build_num': '4701'}])
+        gc.circleci.iter_builds = MagicMock(side_effect=iter_builds)
+        with self.assertRaises(SystemExit):
+            gc.gc_repos(parse_repos(['org/a', 'org/b:test', 'org/c'], 'circleci'))
+        self.assertFalse([c for c in m1.call_args_list if 'delete' in c[0][0]])
+
+    def test_parse_repos(self):
+        self.assertEqual(
+            list(parse_repos(['org/repo', 'org/other:test'], 'circleci').items()),
+            [('org/repo', 'circleci'), ('org/other', 'test')]
         )
-        m1.assert_any_call(["kubectl", "delete", "ns", "circleci-4702"])
-        m1.assert_called_with(['gcloud', 'compute', 'instances', 'delete', '--zone=us-west1-b', '--quiet', 'condor-circleci-4702'])
+
+    def test_gc_builds_snapshot_order(self):
+        calls = []
+        gc = NamespaceGC(True)
+        for name in ['_list_namespaces', '_list_vms', '_list_helm_releases']:
+            setattr(gc, name, MagicMock(
+                side_effect=lambda prefixes, name=name: calls.append(name) or {'circleci': {}}))
+        gc.get_active_builds = MagicMock(
+            side_effect=lambda *args, **kwargs: calls.append('get_active_builds') or [])
+        gc.gc_builds('org/repo')
+        # every resource snapshot is taken before the active builds
+        self.assertEqual(calls[-1], 'get_active_builds')
+        self.assertEqual(len(calls), 4)
+
+
+class TestNameMatcher(unittest.TestCase):
+    def test_namespace(self):
+        matcher = NameMatcher(['circleci', 'test'])
+        self.assertEqual(matcher.namespace('circleci-4701'), ('circleci', '4701'))
+        self.assertEqual(matcher.namespace('test-12'), ('test', '12'))
+        self.assertEqual(matcher.namespace('kube-system'), (None, None))
+        self.assertEqual(matcher.namespace('circleci-4701-x'), (None, None))
+        self.assertEqual(matcher.namespace('xcircleci-4701'), (None, None))
+
+    def test_release(self):
+        matcher = NameMatcher(['test', 'foo-test'])
+        self.assertEqual(matcher.release('web-foo-test-1'), ('foo-test', '1'))
+        self.assertEqual(matcher.release('web-test-2'), ('test', '2'))
+        self.assertEqual(matcher.release('web-test-test-3'), ('test', '3'))
+        self.assertEqual(matcher.release('cron-kube-system'), (None, None))
+
+    def test_vm(self):
+        matcher = NameMatcher(['circleci'])
+        self.assertEqual(matcher.vm('condor-circleci-4701'), ('circleci', '4701'))
+        # str.strip would have turned this into 4701-disk
+        self.assertEqual(matcher.vm('condor-circleci-4701-disk'), (None, None))
+
+    def test_special_characters(self):
+        matcher = NameMatcher(['ci.1'])
+        self.assertEqual(matcher.namespace('ci.1-5'), ('ci.1', '5'))
+        self.assertEqual(matcher.namespace('cix1-5'), (None, None))
+
+    def test_classify(self):
+        matcher = NameMatcher(['circleci', 'test'])
+        self.assertEqual(
+            matcher.classify(matcher.release, ['a-circleci-1', 'b-circleci-1', 'a-test-1', 'other']),
+            {
+                'circleci': {'1': ['a-circleci-1', 'b-circleci-1']},
+                'test': {'1': ['a-test-1']},
+            }
+        )
+
+
+class TestDeleteExecutor(unittest.TestCase):
+    def test_run(self):
+        m1 = MagicMock(return_value='deleted')
+        subprocess.check_output = m1
+        executor = DeleteExecutor(False, chunk_size=2, workers=3)
+        results = executor.run([
+            (['kubectl', 'delete', 'ns'], ['ns-1', 'ns-2', 'ns-3']),
+            (['helm', 'delete', '--purge'], ['release-1']),
+            (['helm', 'delete', '--purge'], []),
+        ])
+        self.assertEqual(m1.call_count, 3)
+        m1.assert_any_call(['kubectl', 'delete', 'ns', 'ns-1', 'ns-2'], stderr=subprocess.STDOUT)
+        m1.assert_any_call(['kubectl', 'delete', 'ns', 'ns-3'], stderr=subprocess.STDOUT)
+        m1.assert_any_call(['helm', 'delete', '--purge', 'release-1'], stderr=subprocess.STDOUT)
+        self.assertEqual(
+            dict(results),
+            {'ns-1': 'deleted', 'ns-2': 'deleted', 'ns-3': 'deleted', 'release-1': 'deleted'}
+        )
+
+    def test_run_failure(self):
+        def check_output(cmd, **kwargs):
+            if 'ns-2' in cmd:
+                raise subprocess.CalledProcessError(1, cmd)
+            return 'deleted'
+        m1 = MagicMock(side_effect=check_output)
+        subprocess.check_output = m1
+        results = DeleteExecutor(False, chunk_size=3).run(
+            [(['kubectl', 'delete', 'ns'], ['ns-1', 'ns-2', 'ns-3'])])
+        self.assertEqual(
+            list(results.items()),
+            [('ns-1', 'deleted'), ('ns-2', 'failed'), ('ns-3', 'deleted')]
+        )
+        self.assertEqual(m1.call_count, 4)
+
+    def test_run_partial_failure(self):
+        # like kubectl, the chunk starts deleting the namespaces it can before
+        # it fails, and they stay terminating for a while
+        phases = {'ns-1': 'Active', 'ns-2': 'Active', 'ns-3': 'Active'}
+
+        def check_output(cmd, **kwargs):
+            lines = []
+            for name in cmd[3:]:
+                if name == 'ns-2':
+                    lines.append('Error from server (Forbidden): namespaces "ns-2" is forbidden')
+                elif phases[name] == 'Terminating':
+                    lines.append(
+                        'Error from server (Conflict): Operation cannot be fulfilled on namespaces '
+                        '"{}": The system is ensuring all content is removed from this namespace.  '
+                        'Upon completion, this namespace will automatically be purged by the '
+                        'system.'.format(name))
+                else:
+                    phases[name] = 'Terminating'
+                    lines.append('namespace "{}" deleted'.format(name))
+            if 'Error' in '\n'.join(lines):
+                raise subprocess.CalledProcessError(1, cmd, output='\n'.join(lines))
+            return '\n'.join(lines)
+        subprocess.check_output = MagicMock(side_effect=check_output)
+        results = DeleteExecutor(False, chunk_size=3).run(
+            [(KubectlBackend().namespace_deleter(), ['ns-1', 'ns-2', 'ns-3'])])
+        self.assertEqual(
+            list(results.items()),
+            [('ns-1', 'deleted'), ('ns-2', 'failed'), ('ns-3', 'deleted')]
+        )
+
+    def test_run_not_found(self):
+        def check_output(cmd, **kwargs):
+            raise subprocess.CalledProcessError(1, cmd, output='Error: release: "web-a" not found')
+        subprocess.check_output = MagicMock(side_effect=check_output)
+        results = DeleteExecutor(False).run(
+            [(['helm', 'delete', '--purge'], ['web-a', 'web-a-b'])])
+        # only a not found naming the release itself counts as deleted
+        self.assertEqual(
+            list(results.items()),
+            [('web-a', 'deleted'), ('web-a-b', 'failed')]
+        )
+
+    def test_run_noop(self):
+        m1 = MagicMock()
+        subprocess.check_output = m1
+        results = DeleteExecutor(True).run([(['kubectl', 'delete', 'ns'], ['ns-1'])])
+        self.assertFalse(m1.called)
+        self.assertEqual(dict(results), {'ns-1': 'noop'})
+
+
+class TestNamespaceGCDaemon(unittest.TestCase):
+    def setUp(self):
+        os.environ['CIRCLE_TOKEN'] = 'foo'
+        self.gc = NamespaceGC(False)
+        self.gc.list_namespaces = MagicMock(return_value={
+            '4701': ['circleci-4701'], '4702': ['circleci-4702']})
+        self.gc.list_vms = MagicMock(return_value={'4701': ['condor-circleci-4701']})
+        self.gc.list_helm_releases = MagicMock(return_value={
+            '4701': ['h-celery-circleci-4701'], '4703': ['h-celery-circleci-4703']})
+        self.gc.circleci.iter_builds = MagicMock(
+            return_value=[{'build_num': 4701}, {'build_num': 4703}])
+        self.gc.circleci.get_single_build_status = MagicMock(
+            return_value={'lifecycle': 'finished'})
+        self.gc.take_inventory = lambda: Inventory(
+            namespaces=self.gc.list_namespaces(),
+            vms=self.gc.list_vms(),
+            releases=self.gc.list_helm_releases(),
+        )
+        self.gc.collect = MagicMock(return_value={})
+        self.daemon = NamespaceGCDaemon(self.gc, 'org/repo')
+
+    def test_resync(self):
+        self.daemon.resync()
+        inventory, running = self.gc.collect.call_args[0]
+        self.assertEqual(running, set(['4701', '4703']))
+        self.assertEqual(sorted(inventory.namespaces), ['4701', '4702'])
+        self.assertEqual(self.daemon.running, set(['4701', '4703']))
+        self.assertEqual(list(self.daemon.inventory.namespaces), ['4701'])
+        self.assertEqual(sorted(self.daemon.inventory.releases), ['4701', '4703'])
+
+    def test_poll_builds(self):
+        self.daemon.resync()
+        self.gc.collect.reset_mock()
+
+        self.daemon.poll_builds()
+        self.assertFalse(self.gc.collect.called)
+
+        self.gc.circleci.iter_builds.return_value = [{'build_num': 4703}]
+        self.daemon.poll_builds()
+        self.gc.circleci.get_single_build_status.assert_called_once_with('org/repo', '4701')
+        inventory, running = self.gc.collect.call_args[0]
+        self.assertEqual(running, [])
+        self.assertEqual(dict(inventory.namespaces), {'4701': ['circleci-4701']})
+        self.assertEqual(dict(inventory.vms), {'4701': ['condor-circleci-4701']})
+        self.assertEqual(dict(inventory.releases), {'4701': ['h-celery-circleci-4701']})
+        self.assertEqual(self.daemon.running, set(['4703']))
+        self.assertEqual(list(self.daemon.inventory.releases), ['4703'])
+
+    def test_poll_builds_not_finished(self):
+        self.daemon.resync()
+        self.gc.collect.reset_mock()
+        self.gc.circleci.get_single_build_status.return_value = {'lifecycle': 'running'}
+        self.gc.circleci.iter_builds.return_value = [{'build_num': 4703}]
+        self.daemon.poll_builds()
+        self.assertFalse(self.gc.collect.called)
+        self.assertEqual(self.daemon.running, set(['4701', '4703']))
+
+    def test_run_survives_failures(self):
+        inventory = self.gc.take_inventory()
+        self.gc.take_inventory = MagicMock(side_effect=[
+            subprocess.CalledProcessError(1, ['helm', 'list', '-q']),
+            inventory,
+        ])
+        self.daemon.stopped.wait = MagicMock(side_effect=[False, False, True])
+        self.gc.circleci.iter_builds = MagicMock(side_effect=[
+            [{'build_num': 4701}, {'build_num': 4703}],
+            requests.ConnectionError('reset'),
+        ])
+        self.daemon.run()
+        # the failed resync is retried on the next tick, then the poll fails
+        self.assertEqual(self.gc.take_inventory.call_count, 2)
+        self.assertEqual(self.gc.collect.call_count, 1)
+        self.assertEqual(self.gc.circleci.iter_builds.call_count, 2)
+        self.assertEqual(self.daemon.running, set(['4701', '4703']))
+
+    def test_apply_namespace_event(self):
+        self.daemon.apply_namespace_event('ADDED', 'circleci-4710', 'Active')
+        self.daemon.apply_namespace_event('ADDED', 'kube-system', 'Active')
+        self.daemon.apply_namespace_event('MODIFIED', 'circleci-4710', 'Active')
+        self.assertEqual(dict(self.daemon.inventory.namespaces), {'4710': ['circleci-4710']})
+        self.daemon.apply_namespace_event('MODIFIED', 'circleci-4710', 'Terminating')
+        self.assertEqual(dict(self.daemon.inventory.namespaces), {})
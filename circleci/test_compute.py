@@ -0,0 +1,234 @@
+import json
+import os
+import re
+import subprocess
+import unittest
+from mock import MagicMock
+
+try:
+    from urlparse import parse_qs, urlparse
+except ImportError:
+    from urllib.parse import parse_qs, urlparse
+
+from circleci.compute import ComputeApiBackend, ComputeApiError, GcloudBackend
+from circleci.fake_server import FakeApi, FakeServerTestCase
+from circleci.namespace_gc import NamespaceGC
+
+
+class FakeComputeApi(FakeApi):
+    # vms served by the fake api server, name to zone
+    instances = {}
+    # operation name to number of polls left before it is done
+    operations = {}
+    requests = []
+    # tokens the fake api server rejects with 401
+    expired_tokens = []
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        self.requests.append(('GET', url.path, query, self.headers.get('Authorization')))
+        if self.headers.get('Authorization') in self.expired_tokens:
+            return self.send_json(401, {'error': {'code': 401}})
+        parts = url.path.split('/')
+        if parts[-2] == 'operations':
+            return self.operation(parts[-4], parts[-1])
+        name_regex = query['filter'][0][len('name eq "'):-1]
+        names = sorted(
+            name for name in self.instances if re.match('^(?:{})$'.format(name_regex), name))
+        start = int(query.get('pageToken', ['0'])[0])
+        limit = int(query['maxResults'][0])
+        items = {}
+        for name in names[start:start + limit]:
+            zone = self.instances[name]
+            items.setdefault('zones/{}'.format(zone), {'instances': []})['instances'].append({
+                'name': name,
+                'zone': 'https://compute/projects/ci/zones/{}'.format(zone),
+            })
+        items['zones/asia-east1-a'] = {'warning': {'code': 'NO_RESULTS_ON_PAGE'}}
+        data = {'items': items}
+        if start + limit < len(names):
+            data['nextPageToken'] = str(start + limit)
+        self.send_json(200, data)
+
+    def operation(self, zone, name):
+        polls = self.operations[name]
+        self.operations[name] = polls - 1
+        data = {'name': name, 'zone': zone, 'status': 'DONE' if polls <= 1 else 'RUNNING'}
+        if polls <= 1 and name.endswith('broken'):
+            data['error'] = {'errors': [{'code': 'RESOURCE_IN_USE'}]}
+        self.send_json(200, data)
+
+    def do_DELETE(self):
+        self.requests.append(('DELETE', self.path, {}, self.headers.get('Authorization')))
+        parts = self.path.split('/')
+        zone, name = parts[-3], parts[-1]
+        if self.instances.get(name) != zone:
+            return self.send_json(404, {'error': {'code': 404}})
+        if not name.endswith('broken'):
+            del self.instances[name]
+        operation = 'delete-{}'.format(name)
+        self.operations[operation] = 2
+        self.send_json(200, {'name': operation, 'zone': zone, 'status': 'PENDING'})
+
+
+class TestComputeApiBackend(FakeServerTestCase):
+    handler = FakeComputeApi
+
+    def setUp(self):
+        os.environ['CIRCLE_TOKEN'] = 'CI_TOKEN'
+        FakeComputeApi.instances = {
+            'condor-circleci-4701': 'us-west1-b',
+            'condor-circleci-4702': 'us-east1-c',
+            'condor-circleci-4703': 'us-west1-b',
+            'condor-circleci-broken': 'us-east1-c',
+            'condor-test-1': 'us-west1-a',
+            'other': 'us-west1-b',
+        }
+        FakeComputeApi.operations = {}
+        FakeComputeApi.requests = []
+        FakeComputeApi.expired_tokens = []
+        FakeServerTestCase.setUp(self)
+        self.url = '{}/compute/v1'.format(self.address)
+
+    def backend(self, **kwargs):
+        return ComputeApiBackend('ci', token='gce-token', endpoint=self.url,
+                                 poll_interval=0, **kwargs)
+
+    def test_list_vms(self):
+        backend = self.backend(page_size=2)
+        self.assertEqual(
+            sorted(backend.list_vms(['circleci'])),
+            ['condor-circleci-4701', 'condor-circleci-4702',
+             'condor-circleci-4703', 'condor-circleci-broken']
+        )
+        self.assertEqual(len(FakeComputeApi.requests), 2)
+        verb, path, query, auth = FakeComputeApi.requests[0]
+        self.assertEqual(path, '/compute/v1/projects/ci/aggregated/instances')
+        self.assertEqual(auth, 'Bearer gce-token')
+        self.assertEqual(backend.zones['condor-circleci-4702'], 'us-east1-c')
+
+    def test_delete_vms(self):
+        backend = self.backend()
+        backend.list_vms(['circleci', 'test'])
+        FakeComputeApi.requests = []
+        backend.delete_vms(['condor-circleci-4701', 'condor-circleci-4702', 'condor-test-1'])
+        self.assertEqual(
+            sorted(FakeComputeApi.instances),
+            ['condor-circleci-4703', 'condor-circleci-broken', 'other'])
+        deletes = [r[1] for r in FakeComputeApi.requests if r[0] == 'DELETE']
+        self.assertEqual(sorted(deletes), [
+            '/compute/v1/projects/ci/zones/us-east1-c/instances/condor-circleci-4702',
+            '/compute/v1/projects/ci/zones/us-west1-a/instances/condor-test-1',
+            '/compute/v1/projects/ci/zones/us-west1-b/instances/condor-circleci-4701',
+        ])
+        # every delete is sent before the first operation is polled
+        verbs = [r[0] for r in FakeComputeApi.requests]
+        self.assertEqual(verbs[:3], ['DELETE'] * 3)
+        self.assertEqual(verbs.count('GET'), 6)
+
+    def test_delete_unlisted_vms(self):
+        backend = self.backend()
+        backend.delete_vms(['condor-circleci-4703', 'condor-circleci-gone'])
+        self.assertNotIn('condor-circleci-4703', FakeComputeApi.instances)
+        self.assertEqual(FakeComputeApi.requests[0][0], 'GET')
+
+    def test_delete_vms_failed(self):
+        backend = self.backend()
+        with self.assertRaises(ComputeApiError):
+            backend.delete_vms(['condor-circleci-broken', 'condor-circleci-4701'])
+        self.assertNotIn('condor-circleci-4701', FakeComputeApi.instances)
+
+    def test_operation_timeout(self):
+        backend = self.backend(operation_timeout=0)
+        with self.assertRaises(ComputeApiError):
+            backend.delete_vms(['condor-circleci-4701'])
+
+    def test_gc_vms(self):
+        m1 = MagicMock(return_value='')
+        subprocess.check_output = m1
+        gc = NamespaceGC(False, compute=self.backend())
+        self.assertEqual(gc.list_vms(), {
+            '4701': ['condor-circleci-4701'],
+            '4702': ['condor-circleci-4702'],
+            '4703': ['condor-circleci-4703'],
+        })
+        results = gc._run_gcloud_vm_delete_cmd(['condor-circleci-4702', 'condor-circleci-broken'])
+        self.assertEqual(
+            dict(results),
+            {'condor-circleci-4702': 'deleted', 'condor-circleci-broken': 'failed'})
+        self.assertFalse(m1.called)
+
+    def test_from_environment(self):
+        os.environ['GOOGLE_PROJECT_ID'] = 'ci'
+        os.environ.pop('GOOGLE_ACCESS_TOKEN', None)
+        subprocess.check_output = MagicMock(return_value='gcloud-token\n')
+        backend = ComputeApiBackend.from_environment()
+        self.assertEqual(backend.headers['Authorization'], 'Bearer gcloud-token')
+        subprocess.check_output.assert_called_once_with(['gcloud', 'auth', 'print-access-token'])
+        del os.environ['GOOGLE_PROJECT_ID']
+
+
+    def test_refresh_token(self):
+        subprocess.check_output = MagicMock(side_effect=['token-1\n', 'token-2\n', 'token-3\n'])
+        backend = ComputeApiBackend('ci', endpoint=self.url, poll_interval=0,
+                                    token_command=['gcloud', 'auth', 'print-access-token'])
+        self.assertEqual(backend.headers['Authorization'], 'Bearer token-1')
+
+        # rejected tokens are replaced and the request sent again
+        FakeComputeApi.expired_tokens = ['Bearer token-1']
+        self.assertEqual(len(backend.list_vms(['test'])), 1)
+        self.assertEqual(
+            [r[3] for r in FakeComputeApi.requests], ['Bearer token-1', 'Bearer token-2'])
+
+        # tokens about to expire are replaced before they are used
+        backend.token_expires = 0
+        backend.list_vms(['test'])
+        self.assertEqual(FakeComputeApi.requests[-1][3], 'Bearer token-3')
+        self.assertEqual(subprocess.check_output.call_count, 3)
+
+
+class TestGcloudBackend(unittest.TestCase):
+    def test_list_vms(self):
+        subprocess.check_output = MagicMock(return_value='[{"name": "condor-circleci-4701"}]'.replace(
+            '}', ', "zone": "https://www.googleapis.com/compute/v1/projects/ci/zones/us-west1-b"}'))
+        backend = GcloudBackend()
+        self.assertEqual(backend.list_vms(['circleci']), ['condor-circleci-4701'])
+        self.assertEqual(subprocess.check_output.call_args[0][0][5], 'name:(condor-circleci-*)')
+        self.assertEqual(backend.zones, {'condor-circleci-4701': 'us-west1-b'})
+
+    def test_delete_vms(self):
+        deleted = []
+
+        def check_output(cmd, **kwargs):
+            if cmd[3] == 'list':
+                return json.dumps([
+                    {'name': 'condor-circleci-4701', 'zone': 'us-west1-b'},
+                    {'name': 'condor-circleci-4702', 'zone': 'us-east1-c'},
+                    {'name': 'condor-circleci-4703', 'zone': 'us-east1-c'},
+                ])
+            zone = cmd[5].split('=')[1]
+            if 'condor-circleci-4703' in cmd:
+                raise subprocess.CalledProcessError(1, cmd, output=(
+                    "ERROR: (gcloud.compute.instances.delete) Could not fetch resource:\n"
+                    " - The resource 'projects/ci/zones/{}/instances/condor-circleci-4703' "
+                    "was not found\n".format(zone)))
+            deleted.extend((zone, name) for name in cmd[6:])
+            return ''
+        subprocess.check_output = MagicMock(side_effect=check_output)
+        backend = GcloudBackend()
+        backend.list_vms(['circleci'])
+        deleter = backend.vm_deleter()
+        deleter(['condor-circleci-4701', 'condor-circleci-4702'])
+        # every vm is deleted in its own zone
+        self.assertEqual(
+            sorted(deleted),
+            [('us-east1-c', 'condor-circleci-4702'), ('us-west1-b', 'condor-circleci-4701')]
+        )
+        deleter(['condor-circleci-4703'])
+
+        # a vm reported missing from another zone was not deleted
+        subprocess.check_output = MagicMock(side_effect=subprocess.CalledProcessError(
+            1, [], output="The resource 'projects/ci/zones/us-west1-b/instances/condor-circleci-4703' was not found"))
+        with self.assertRaises(ComputeApiError):
+            deleter(['condor-circleci-4703'])
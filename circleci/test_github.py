@@ -1,9 +1,11 @@
 import os
+import shutil
+import tempfile
 import unittest
 import json
-from mock import patch
+from mock import MagicMock, patch
 
-from circleci.github import Github, GithubPullRequest, GithubStatus
+from circleci.github import Github, GithubPullRequest, GithubStatus, PullRequestRegistry
 
 
 class TestGithub(unittest.TestCase):
@@ -16,12 +18,35 @@ class TestGithub(unittest.TestCase):
 
         gh = Github()
         self.assertEqual(gh.oauth, 'GH_TOKEN')
+        self.assertEqual(gh.cache, None)
+
+    @patch('requests.Session.get')
+    def test_conditional_get(self, req):
+        os.environ['GH_OAUTH_TOKEN'] = 'GH_TOKEN'
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+        url = 'https://api.github.com/repos/octocat/Hello-World/pulls/1'
+
+        ok = MagicMock(status_code=200, headers={'ETag': '"abc"'})
+        ok.json.return_value = {'state': 'open'}
+        req.return_value = ok
+        self.assertEqual(Github(cache_dir=cache_dir).get(url), {'state': 'open'})
+
+        req.return_value = MagicMock(status_code=304, headers={})
+        gh = Github(cache_dir=cache_dir)
+        self.assertEqual(gh.get(url), {'state': 'open'})
+        req.assert_called_with(url, headers={
+            'Authorization': 'token GH_TOKEN',
+            'Content-Type': 'application/json',
+            'If-None-Match': '"abc"'
+        })
 
 
 class TestGithubPullRequest(unittest.TestCase):
     class PullRequestGetMock():
         def __init__(self):
             self.status_code = 200
+            self.headers = {}
             self.text = '{}'
 
         def json(self):
@@ -73,7 +98,7 @@ class TestGithubPullRequest(unittest.TestCase):
 
         self.assertTrue('ERROR: Invalid url: {}'.format(test_urls[2]) in context.exception)
 
-    @patch('requests.get', return_value=PullRequestGetMock())
+    @patch('requests.Session.get', return_value=PullRequestGetMock())
     def test_parse_pr(self, url):
         pr = GithubPullRequest('https://github.com/octocat/Hello-world/pull/124')
         self.assertEqual(
@@ -83,7 +108,7 @@ class TestGithubPullRequest(unittest.TestCase):
         self.assertEqual(pr.branch, 'branch-name')
         self.assertEqual(pr.status_url, 'https://api.github.com/repos/octocat/Hello-world/statuses/6dcb09b5b57875f334f61aebed695e2e4193db5e')
 
-    @patch('requests.get', return_value=PullRequestGetMock())
+    @patch('requests.Session.get', return_value=PullRequestGetMock())
     def test_pull_requests(self, url):
         pr = GithubPullRequest('https://github.com/octocat/Hello-world/pull/124')
         self.assertEqual(
@@ -98,10 +123,148 @@ class TestGithubPullRequest(unittest.TestCase):
         )
 
 
+class TestPullRequestRegistry(unittest.TestCase):
+    def setUp(self):
+        os.environ['GH_OAUTH_TOKEN'] = 'GH_TOKEN'
+
+    def test_canonical_url(self):
+        self.assertEqual(
+            PullRequestRegistry.canonical_url('http://github.com/OctoCat/Hello-World/pull/124/'),
+            'https://github.com/octocat/hello-world/pull/124'
+        )
+        with self.assertRaises(ValueError):
+            PullRequestRegistry.canonical_url('https://api.github.com/repos/octocat/Hello-World/pulls/1')
+
+    @patch('requests.Session.get', return_value=TestGithubPullRequest.PullRequestGetMock())
+    def test_get(self, req):
+        registry = PullRequestRegistry()
+        pr = registry.get('https://github.com/octocat/Hello-World/pull/124')
+        self.assertTrue(registry.get('http://github.com/octocat/hello-world/pull/124/') is pr)
+        self.assertEqual(pr.sha, '6dcb09b5b57875f334f61aebed695e2e4193db5e')
+        self.assertEqual(req.call_count, 1)
+
+        registry.get('https://github.com/octocat/Hello-World/pull/125')
+        self.assertEqual(req.call_count, 2)
+
+    @patch('requests.Session.get', return_value=TestGithubPullRequest.PullRequestGetMock())
+    def test_fetch_all(self, req):
+        registry = PullRequestRegistry(concurrency=4)
+        urls = ['https://github.com/octocat/Hello-World/pull/{}'.format(i) for i in range(10)]
+        prs = registry.fetch_all(urls + ['http://github.com/octocat/hello-world/pull/1/'])
+        self.assertEqual(req.call_count, 10)
+        self.assertEqual([pr.number for pr in prs[:10]], [str(i) for i in range(10)])
+        self.assertTrue(prs[10] is prs[1])
+
+        registry.fetch_all(urls)
+        self.assertEqual(req.call_count, 10)
+
+    @staticmethod
+    def linked_pull_request(url, headers):
+        # 1 links 2, 2 links 3 and 4, 3 links back to 1, 6 is merged
+        number = url.split('/')[-1]
+        links = {'1': [2], '2': [3, 4], '3': [1], '4': [], '5': [1], '6': [7], '8': [6]}[number]
+        body = '```\npull_requests:\n{}\n```'.format(''.join(
+            '  - https://github.com/octocat/Hello-World/pull/{}\n'.format(n) for n in links))
+        resp = MagicMock(status_code=200, headers={})
+        resp.json.return_value = {
+            'body': body if links else None,
+            'state': 'closed' if number == '6' else 'open',
+            'head': {'sha': 'abc', 'ref': 'branch', 'repo': {'full_name': 'octocat/Hello-World'}},
+        }
+        return resp
+
+    @patch('requests.Session.get')
+    def test_resolve(self, req):
+        req.side_effect = self.linked_pull_request
+        registry = PullRequestRegistry()
+        self.assertEqual(
+            registry.resolve(['https://github.com/octocat/Hello-World/pull/1']),
+            ['https://github.com/octocat/Hello-World/pull/{}'.format(n) for n in [1, 2, 3, 4]]
+        )
+        self.assertEqual(req.call_count, 4)
+
+        # already fetched pull requests come from the registry
+        self.assertEqual(
+            registry.resolve(['https://github.com/octocat/Hello-World/pull/5'], depth=1),
+            ['https://github.com/octocat/Hello-World/pull/5',
+             'https://github.com/octocat/Hello-World/pull/1']
+        )
+        self.assertEqual(req.call_count, 5)
+
+    @staticmethod
+    def graphql_response(url, headers, data):
+        request = json.loads(data)
+        result = {}
+        for key, value in request['variables'].items():
+            if key.startswith('number'):
+                i = key[len('number'):]
+                result['pr{}'.format(i)] = None if value == 404 else {'pullRequest': {
+                    'body': None,
+                    'state': 'MERGED' if value == 2 else 'OPEN',
+                    'headRefOid': 'sha{}'.format(value),
+                    'headRefName': 'branch{}'.format(value),
+                    'headRepository': {'nameWithOwner': '{}/{}'.format(
+                        request['variables']['owner' + i], request['variables']['name' + i])},
+                }}
+        resp = MagicMock(status_code=200, headers={})
+        resp.json.return_value = {'data': result}
+        return resp
+
+    @patch('requests.Session.get')
+    @patch('requests.Session.post')
+    def test_fetch_all_graphql(self, post, get):
+        post.side_effect = self.graphql_response
+        registry = PullRequestRegistry(graphql=True)
+        urls = ['https://github.com/octocat/Hello-World/pull/{}'.format(i) for i in range(1, 121)]
+        prs = registry.fetch_all(urls)
+        self.assertFalse(get.called)
+        # 120 pull requests in chunks of 50
+        self.assertEqual(post.call_count, 3)
+        self.assertEqual(post.call_args[0][0], 'https://api.github.com/graphql')
+        query = json.loads(post.call_args_list[0][1]['data'])['query']
+        self.assertEqual(query.count('pullRequest(number:'), 50)
+        self.assertEqual([pr.sha for pr in prs], ['sha{}'.format(i) for i in range(1, 121)])
+        self.assertFalse(prs[1].active)
+        self.assertTrue(prs[0].active)
+        self.assertEqual(prs[0].repo_full_name, 'octocat/Hello-World')
+        self.assertEqual(prs[0].branch, 'branch1')
+        self.assertEqual(
+            prs[0].status_url, 'https://api.github.com/repos/octocat/Hello-World/statuses/sha1')
+        self.assertTrue(registry.get(urls[5]) is prs[5])
+
+        with self.assertRaises(Exception):
+            registry.fetch_all(['https://github.com/octocat/Hello-World/pull/404'])
+
+    @patch('requests.Session.get')
+    def test_resolve_closed(self, req):
+        req.side_effect = self.linked_pull_request
+        registry = PullRequestRegistry()
+        self.assertEqual(
+            registry.resolve(['https://github.com/octocat/Hello-World/pull/8']),
+            ['https://github.com/octocat/Hello-World/pull/8',
+             'https://github.com/octocat/Hello-World/pull/6']
+        )
+        # 7 is only linked from the merged pull request
+        self.assertEqual(req.call_count, 2)
+
+    @patch('requests.Session.get')
+    def test_resolve_depth(self, req):
+        req.side_effect = self.linked_pull_request
+        registry = PullRequestRegistry()
+        self.assertEqual(
+            registry.resolve(['https://github.com/octocat/Hello-World/pull/1'], depth=1),
+            ['https://github.com/octocat/Hello-World/pull/1',
+             'https://github.com/octocat/Hello-World/pull/2']
+        )
+        # links of the last level are not fetched
+        self.assertEqual(req.call_count, 2)
+
+
 class TestGithubStatus(unittest.TestCase):
     class RequestMock():
         def __init__(self):
             self.status_code = 200
+            self.headers = {}
             self.text = '{}'
 
         def json(self):
@@ -149,7 +312,7 @@ class TestGithubStatus(unittest.TestCase):
             'https://api.github.com/repos/nanliu/circleci/statuses/6dcb09b5b57875f334f61aebed695e2e4193db5e'
         )
 
-    @patch('requests.post', autospec=True, return_value=RequestMock())
+    @patch('requests.Session.post', return_value=RequestMock())
     def test_create_status(self, req):
         pr = GithubStatus()
         pr.create_status(
@@ -172,7 +335,7 @@ class TestGithubStatus(unittest.TestCase):
             }),
         )
 
-    @patch('requests.post', autospec=True, return_value=RequestMock())
+    @patch('requests.Session.post', return_value=RequestMock())
     def test_create_status_with_url(self, req):
         pr = GithubStatus()
         pr.create_status(
@@ -196,7 +359,30 @@ class TestGithubStatus(unittest.TestCase):
             }),
         )
 
-    @patch('requests.get', autospec=True, return_value=RequestMock())
+    @patch('requests.Session.post')
+    def test_create_statuses(self, req):
+        failed = self.RequestMock()
+        failed.status_code = 500
+        urls = [
+            'https://api.github.com/repos/nanliu/circleci/statuses/1',
+            'https://api.github.com/repos/nanliu/circleci/statuses/2',
+            'https://api.github.com/repos/nanliu/circleci/statuses/3',
+        ]
+        req.side_effect = lambda url, **kwargs: failed if url == urls[1] else self.RequestMock()
+        pr = GithubStatus()
+        results = pr.create_statuses(
+            'pending',
+            'https://ci.example.com/1000/output',
+            'Build has started',
+            'continuous-integration/jenkins',
+            urls,
+            concurrency=3,
+        )
+        self.assertEqual(req.call_count, 3)
+        self.assertEqual(list(results.keys()), urls)
+        self.assertEqual(list(results.values()), [{}, None, {}])
+
+    @patch('requests.Session.get', return_value=RequestMock())
     def test_get_combined_status(self, req):
         pr = GithubStatus()
         pr.get_combined_status()
@@ -208,7 +394,7 @@ class TestGithubStatus(unittest.TestCase):
             },
         )
 
-    @patch('requests.get', autospec=True, return_value=RequestMock())
+    @patch('requests.Session.get', return_value=RequestMock())
     def test_get_combined_status_with_url(self, req):
         pr = GithubStatus()
         pr.get_combined_status(url='https://api.github.com/repos/nanliu/circleci/commits/6dcb09b5b57875f334f61aebed695e2e4193db5e/status')
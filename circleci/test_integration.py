@@ -1,12 +1,28 @@
 import os
+import shutil
+import tempfile
 import unittest
 import json
+from collections import OrderedDict
 from mock import MagicMock, patch
+import requests
+
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
 
 from circleci.github import GithubPullRequest, GithubStatus
 import integration
 
 
+def listing(builds):
+    # a background listing of running builds that has finished
+    result = MagicMock()
+    result.get.return_value = builds
+    return result
+
+
 class TestIntegration(unittest.TestCase):
     maxDiff = None
 
@@ -18,6 +34,7 @@ class TestIntegration(unittest.TestCase):
     class PullRequestGetMock():
         def __init__(self):
             self.status_code = 200
+            self.headers = {}
 
         def json(self):
             pull_request_response_example = r'''{
@@ -37,7 +54,7 @@ class TestIntegration(unittest.TestCase):
 }'''
             return json.loads(pull_request_response_example)
 
-    @patch('requests.get', return_value=PullRequestGetMock())
+    @patch('requests.Session.get', return_value=PullRequestGetMock())
     def test_get_description_section(self, patch1):
         current_pull_request = GithubPullRequest('https://github.com/nanliu/circleci/pull/32')
         urls = current_pull_request.get_description_section('pull_requests', '```')
@@ -46,7 +63,7 @@ class TestIntegration(unittest.TestCase):
             ['https://github.com/octocat/Hello-world/pull/123']
         )
 
-    @patch('requests.get', return_value=PullRequestGetMock())
+    @patch('requests.Session.get', return_value=PullRequestGetMock())
     def test_init(self, req):
         pr = integration.Integration('nanliu/circleci')
         self.assertEqual(pr.repo, 'nanliu/circleci')
@@ -54,7 +71,7 @@ class TestIntegration(unittest.TestCase):
         self.assertEqual(pr.build_param,  {})
         self.assertEqual(pr.context,  'ci/circleci-integration')
 
-    @patch('requests.get', return_value=PullRequestGetMock())
+    @patch('requests.Session.get', return_value=PullRequestGetMock())
     def test_filter_active_pr(self, req):
         pr = integration.Integration('nanliu/circleci')
         self.assertEqual(
@@ -66,7 +83,7 @@ class TestIntegration(unittest.TestCase):
             'master'
         )
 
-    @patch('requests.get', return_value=PullRequestGetMock())
+    @patch('requests.Session.get', return_value=PullRequestGetMock())
     def test_filter_integration_branch(self, req):
         pr = integration.Integration('nanliu/circleci')
         self.assertEqual(
@@ -78,11 +95,12 @@ class TestIntegration(unittest.TestCase):
             'test_branch'
         )
 
-    @patch('requests.get', return_value=PullRequestGetMock())
+    @patch('requests.Session.get', return_value=PullRequestGetMock())
     def test_run(self, req):
         pr = integration.Integration('nanliu/circleci')
         pr.build = MagicMock()
         pr.update_status = MagicMock()
+        pr.list_running_builds = MagicMock(return_value=listing([]))
         pr.run()
         self.assertEqual(
             pr.build_param['PR_URL'],
@@ -108,6 +126,7 @@ class TestIntegration(unittest.TestCase):
         )
         pr.build = MagicMock()
         pr.update_status = MagicMock()
+        pr.list_running_builds = MagicMock(return_value=listing([]))
         pr.run()
         self.assertEqual(
             pr.build_param['PR_URL'],
@@ -132,5 +151,266 @@ class TestIntegration(unittest.TestCase):
         )
         pr.build = MagicMock()
         pr.update_status = MagicMock()
+        pr.list_running_builds = MagicMock(return_value=listing([]))
         with self.assertRaises(ValueError) as context:
             pr.run()
+
+    @patch('requests.Session.post', return_value=MagicMock(status_code=201, headers={}))
+    def test_update_status(self, req):
+        pr = integration.Integration('nanliu/circleci', concurrency=2)
+        pr.build_num = 12
+        pr.build_url = 'https://circleci.com/gh/nanliu/circleci/12'
+        pr.status_urls = [
+            'https://api.github.com/repos/nanliu/circleci/statuses/1',
+            'https://api.github.com/repos/octocat/Hello-world/statuses/2',
+        ]
+        pr.update_status()
+        for url in pr.status_urls:
+            req.assert_any_call(
+                url,
+                headers={
+                    'Content-Type': 'application/json',
+                    'Authorization': 'token GH_TOKEN'
+                },
+                data=json.dumps({
+                    'state': 'pending',
+                    'target_url': 'https://circleci.com/gh/nanliu/circleci/12',
+                    'description': 'The integration build 12 started',
+                    'context': 'ci/circleci-integration'
+                }),
+            )
+
+    @patch('requests.Session.get', return_value=PullRequestGetMock())
+    def test_run_fetches_each_pr_once(self, req):
+        pr = integration.Integration('nanliu/circleci')
+        pr.build = MagicMock()
+        pr.update_status = MagicMock()
+        pr.list_running_builds = MagicMock(return_value=listing([]))
+        pr.run()
+        # the current PR and the PR linked in its description
+        self.assertEqual(req.call_count, 2)
+
+    @patch('requests.Session.get', return_value=PullRequestGetMock())
+    def test_run_jsonmerge(self, req):
+        pr = integration.Integration(
+            'nanliu/circleci',
+            build_param={"CUSTOM_VALUES": '{"circleci": {"env": {"a": 1}}}'},
+            jsonmerge=True
+        )
+        pr.build = MagicMock()
+        pr.update_status = MagicMock()
+        pr.list_running_builds = MagicMock(return_value=listing([]))
+        pr.run()
+        self.assertEqual(
+            json.loads(pr.build_param['CUSTOM_VALUES']),
+            {'circleci': {'env': {'a': 1}, 'repo': 'circleci', 'tag': 'a96e5a6dfba3a96d27bfcbef66717ea51ffeacb8'}}
+        )
+
+    @patch('sys.stdout', new_callable=StringIO)
+    def test_merge_custom_values(self, stdout):
+        self.assertEqual(
+            list(integration.merge_custom_values(
+                OrderedDict([
+                    ('user', {'replicas': 2}),
+                    ('web', {'repo': 'web', 'tag': 'old', 'replicas': 3}),
+                ]),
+                [
+                    {'web': {'repo': 'web', 'tag': 'a'}},
+                    {'api': {'repo': 'api', 'tag': 'b'}},
+                ],
+            ).items()),
+            [
+                ('user', {'replicas': 2}),
+                ('web', {'repo': 'web', 'tag': 'a', 'replicas': 3}),
+                ('api', {'repo': 'api', 'tag': 'b'}),
+            ]
+        )
+        # overriding user tags is the point, not a conflict
+        self.assertEqual(stdout.getvalue(), '')
+
+    @patch('sys.stdout', new_callable=StringIO)
+    def test_merge_custom_values_conflict(self, stdout):
+        result = integration.merge_custom_values({}, [
+            {'web': {'repo': 'web', 'tag': 'a'}},
+            {'web': {'repo': 'web', 'tag': 'b'}},
+        ])
+        self.assertEqual(result['web']['tag'], 'b')
+        self.assertIn('Conflicting tags for web: a and b', stdout.getvalue())
+
+    @patch('requests.Session.get', return_value=PullRequestGetMock())
+    def test_run_attaches_to_running_build(self, req):
+        pr = integration.Integration('nanliu/circleci', build_param={})
+        pr.build = MagicMock()
+        pr.update_status = MagicMock()
+        pr.list_running_builds = MagicMock(return_value=listing([]))
+        pr.run()
+        self.assertEqual(len(pr.build_param['INTEGRATION_FINGERPRINT']), 40)
+        self.assertTrue(pr.build.called)
+
+        running = {
+            'build_num': 77,
+            'build_url': 'https://circleci.com/gh/nanliu/circleci/77',
+            'build_parameters': dict(pr.build_param),
+        }
+        again = integration.Integration('nanliu/circleci', build_param={})
+        again.build = MagicMock()
+        again.update_status = MagicMock()
+        again.list_running_builds = MagicMock(return_value=listing([{'build_num': 76, 'build_parameters': None}, running]))
+        again.run()
+        self.assertFalse(again.build.called)
+        self.assertEqual(again.build_num, 77)
+        self.assertEqual(again.build_url, 'https://circleci.com/gh/nanliu/circleci/77')
+        self.assertTrue(again.update_status.called)
+
+        again = integration.Integration('nanliu/circleci', build_param={}, dedupe=False)
+        again.build = MagicMock()
+        again.update_status = MagicMock()
+        again.list_running_builds = MagicMock(return_value=listing([running]))
+        again.run()
+        self.assertTrue(again.build.called)
+
+    @patch('requests.Session.get', return_value=PullRequestGetMock())
+    def test_run_lists_running_builds_while_resolving(self, req):
+        pr = integration.Integration('nanliu/circleci', build_param={})
+        pr.build = MagicMock()
+        pr.update_status = MagicMock()
+
+        def list_running_builds():
+            # started before the pull requests are resolved
+            self.assertNotIn('PR_URL', pr.build_param)
+            return listing([])
+        pr.list_running_builds = MagicMock(side_effect=list_running_builds)
+        pr.run()
+        self.assertTrue(pr.list_running_builds.called)
+        self.assertTrue(pr.build.called)
+
+        again = integration.Integration('nanliu/circleci', build_param={}, dedupe=False)
+        again.build = MagicMock()
+        again.update_status = MagicMock()
+        again.list_running_builds = MagicMock()
+        again.run()
+        self.assertFalse(again.list_running_builds.called)
+
+    def test_list_running_builds(self):
+        def iter_builds(self, repo, branch=None, filter='running'):
+            for build_num in [77, 76]:
+                yield {'build_num': build_num}
+        with patch('circleci.base.CircleCIBase.iter_builds', iter_builds):
+            pr = integration.Integration('nanliu/circleci', build_param={})
+            self.assertEqual(
+                pr.running_builds(pr.list_running_builds()),
+                [{'build_num': 77}, {'build_num': 76}]
+            )
+
+    @patch('requests.Session.get', return_value=PullRequestGetMock())
+    def test_run_running_builds_fail(self, req):
+        pr = integration.Integration('nanliu/circleci', build_param={}, cancel_superseded=True)
+        pr.build = MagicMock()
+        pr.update_status = MagicMock()
+        failed = MagicMock()
+        failed.get.side_effect = requests.ConnectionError('connection reset')
+        pr.list_running_builds = MagicMock(return_value=failed)
+        pr.run()
+        self.assertTrue(pr.build.called)
+
+    def test_fingerprint(self):
+        a = integration.Integration('nanliu/circleci', build_param={'PR_URL': '1', 'CUSTOM_VALUES': '{}'})
+        b = integration.Integration('nanliu/circleci', build_param={'CUSTOM_VALUES': '{}', 'PR_URL': '1'})
+        self.assertEqual(a.fingerprint(), b.fingerprint())
+        b.build_param['CUSTOM_VALUES'] = '{"a": 1}'
+        self.assertNotEqual(a.fingerprint(), b.fingerprint())
+        b = integration.Integration('nanliu/circleci', branch='other', build_param={'PR_URL': '1', 'CUSTOM_VALUES': '{}'})
+        self.assertNotEqual(a.fingerprint(), b.fingerprint())
+
+    @patch('circleci.base.CircleCIBase.cancel_build', return_value={})
+    @patch('requests.Session.get', return_value=PullRequestGetMock())
+    def test_run_cancels_superseded_builds(self, req, cancel):
+        def build(build_num, heads):
+            return {
+                'build_num': build_num,
+                'build_url': 'https://circleci.com/gh/nanliu/circleci/{}'.format(build_num),
+                'build_parameters': {'PR_HEADS': json.dumps(heads)},
+            }
+        running = [
+            build(70, {'https://github.com/nanliu/circleci/pull/32': 'old'}),
+            build(71, {'https://github.com/nanliu/circleci/pull/32': 'a96e5a6dfba3a96d27bfcbef66717ea51ffeacb8'}),
+            build(72, {'https://github.com/nanliu/circleci/pull/99': 'old'}),
+            {'build_num': 73, 'build_parameters': {'PR_HEADS': 'bad'}},
+            {'build_num': 74, 'build_parameters': None},
+        ]
+        pr = integration.Integration('nanliu/circleci', build_param={}, cancel_superseded=True)
+        pr.build = MagicMock()
+        pr.update_status = MagicMock()
+        pr.list_running_builds = MagicMock(return_value=listing(running))
+        pr.run()
+        cancel.assert_called_once_with('nanliu/circleci', 70)
+        self.assertEqual(
+            json.loads(pr.build_param['PR_HEADS']),
+            {'https://github.com/nanliu/circleci/pull/32': 'a96e5a6dfba3a96d27bfcbef66717ea51ffeacb8'}
+        )
+        self.assertTrue(pr.build.called)
+
+        pr = integration.Integration('nanliu/circleci', build_param={})
+        pr.build = MagicMock()
+        pr.update_status = MagicMock()
+        pr.list_running_builds = MagicMock(return_value=listing(running))
+        pr.run()
+        self.assertEqual(cancel.call_count, 1)
+
+    @patch('circleci.base.CircleCIBase.cancel_build', return_value={})
+    @patch('requests.Session.get', return_value=PullRequestGetMock())
+    def test_run_cancels_superseded_builds_on_reuse(self, req, cancel):
+        pr = integration.Integration('nanliu/circleci', build_param={}, cancel_superseded=True,
+                                     reuse_results=True)
+        pr.build = MagicMock()
+        pr.update_status = MagicMock()
+        pr.list_running_builds = MagicMock(return_value=listing([{
+            'build_num': 70,
+            'build_parameters': {'PR_HEADS': json.dumps({'https://github.com/nanliu/circleci/pull/32': 'old'})},
+        }]))
+        pr.reuse_passed_build = MagicMock(return_value=True)
+        pr.run()
+        cancel.assert_called_once_with('nanliu/circleci', 70)
+        self.assertFalse(pr.build.called)
+
+    @patch('circleci.base.CircleCIBase.iter_builds')
+    @patch('requests.Session.get', return_value=PullRequestGetMock())
+    def test_run_reuses_passed_build(self, req, iter_builds):
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        results_file = os.path.join(path, 'results.json')
+
+        pr = integration.Integration('nanliu/circleci', build_param={}, reuse_results=True,
+                                     results_file=results_file)
+        pr.build = MagicMock()
+        pr.update_status = MagicMock()
+        pr.list_running_builds = MagicMock(return_value=listing([]))
+        iter_builds.return_value = iter([])
+        pr.run()
+        self.assertTrue(pr.build.called)
+        iter_builds.assert_called_with('nanliu/circleci', branch='test_branch', filter='successful')
+
+        passed = {
+            'build_num': 80,
+            'build_url': 'https://circleci.com/gh/nanliu/circleci/80',
+            'build_parameters': dict(pr.build_param),
+        }
+        for i in range(2):
+            again = integration.Integration('nanliu/circleci', build_param={}, reuse_results=True,
+                                            results_file=results_file)
+            again.build = MagicMock()
+            again.update_status = MagicMock()
+            again.list_running_builds = MagicMock(return_value=listing([]))
+            iter_builds.reset_mock()
+            iter_builds.return_value = iter([{'build_num': 81, 'build_parameters': {}}, passed])
+            with patch('circleci.github.GithubStatus.create_statuses') as statuses:
+                again.run()
+            self.assertFalse(again.build.called)
+            self.assertFalse(again.update_status.called)
+            self.assertEqual(again.build_num, 80)
+            statuses.assert_called_once_with(
+                'success', 'https://circleci.com/gh/nanliu/circleci/80',
+                'The integration build 80 passed', 'ci/circleci-integration',
+                again.status_urls, concurrency=None)
+            # the second run finds the build in the results file
+            self.assertEqual(iter_builds.called, i == 0)
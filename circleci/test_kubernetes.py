@@ -0,0 +1,199 @@
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+import yaml
+from mock import MagicMock
+
+try:
+    from urlparse import parse_qs, urlparse
+except ImportError:
+    from urllib.parse import parse_qs, urlparse
+
+from circleci.fake_server import FakeApi, FakeServerTestCase
+from circleci.kubernetes import KubectlBackend, KubernetesApiBackend, KubernetesApiError
+from circleci.namespace_gc import NamespaceGC
+
+
+class FakeKubernetesApi(FakeApi):
+    # namespaces served by the fake api server, name to phase
+    namespaces = {}
+    requests = []
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        self.requests.append(('GET', url.path, query, self.headers.get('Authorization')))
+        if query.get('watch') == ['true']:
+            return self.watch(query)
+        names = sorted(
+            name for name, phase in self.namespaces.items()
+            if query.get('fieldSelector') != ['status.phase=Active'] or phase == 'Active'
+        )
+        start = int(query.get('continue', ['0'])[0])
+        limit = int(query['limit'][0])
+        page = names[start:start + limit]
+        metadata = {}
+        if start + limit < len(names):
+            metadata['continue'] = str(start + limit)
+        self.send_json(200, {
+            'items': [{'metadata': {'name': name}} for name in page],
+            'metadata': metadata,
+        })
+
+    def watch(self, query):
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.end_headers()
+        events = [
+            ('ADDED', 'circleci-4710', 'Active', '11'),
+            ('MODIFIED', 'circleci-4701', 'Terminating', '12'),
+            ('DELETED', 'circleci-4701', 'Terminating', '13'),
+        ]
+        for event, name, phase, version in events:
+            self.wfile.write((json.dumps({'type': event, 'object': {
+                'metadata': {'name': name, 'resourceVersion': version},
+                'status': {'phase': phase},
+            }}) + '\n').encode('utf-8'))
+
+    def do_DELETE(self):
+        self.requests.append(('DELETE', self.path, {}, self.headers.get('Authorization')))
+        name = self.path.split('/')[-1]
+        if name == 'forbidden':
+            self.send_json(403, {'reason': 'Forbidden'})
+        elif name not in self.namespaces:
+            self.send_json(404, {'reason': 'NotFound'})
+        else:
+            self.namespaces[name] = 'Terminating'
+            self.send_json(200, {'metadata': {'name': name}})
+
+
+class TestKubernetesApiBackend(FakeServerTestCase):
+    handler = FakeKubernetesApi
+
+    def setUp(self):
+        os.environ['CIRCLE_TOKEN'] = 'CI_TOKEN'
+        FakeKubernetesApi.namespaces = {
+            'default': 'Active',
+            'circleci-4701': 'Active',
+            'circleci-4702': 'Active',
+            'circleci-4703': 'Terminating',
+            'other': 'Active',
+        }
+        FakeKubernetesApi.requests = []
+        FakeServerTestCase.setUp(self)
+        self.url = self.address
+
+    def test_list_namespaces(self):
+        backend = KubernetesApiBackend(self.url, token='k8s-token', page_size=2,
+                                       label_selector='ci=circleci')
+        self.assertEqual(
+            backend.list_namespaces(),
+            ['circleci-4701', 'circleci-4702', 'default', 'other']
+        )
+        self.assertEqual(len(FakeKubernetesApi.requests), 2)
+        verb, path, query, auth = FakeKubernetesApi.requests[0]
+        self.assertEqual(path, '/api/v1/namespaces')
+        self.assertEqual(query['fieldSelector'], ['status.phase=Active'])
+        self.assertEqual(query['labelSelector'], ['ci=circleci'])
+        self.assertEqual(auth, 'Bearer k8s-token')
+
+    def test_watch_namespaces(self):
+        backend = KubernetesApiBackend(self.url)
+        backend.resource_version = '10'
+        self.assertEqual(
+            list(backend.watch_namespaces(timeout=5)),
+            [
+                ('ADDED', 'circleci-4710', 'Active'),
+                ('MODIFIED', 'circleci-4701', 'Terminating'),
+                ('DELETED', 'circleci-4701', 'Terminating'),
+            ]
+        )
+        query = FakeKubernetesApi.requests[0][2]
+        self.assertEqual(query['resourceVersion'], ['10'])
+        self.assertEqual(query['timeoutSeconds'], ['5'])
+        self.assertEqual(backend.resource_version, '13')
+
+    def test_delete_namespaces(self):
+        backend = KubernetesApiBackend(self.url)
+        backend.delete_namespaces(['circleci-4701', 'missing'])
+        self.assertEqual(FakeKubernetesApi.namespaces['circleci-4701'], 'Terminating')
+        with self.assertRaises(KubernetesApiError):
+            backend.delete_namespaces(['forbidden'])
+
+    def test_gc_namespaces(self):
+        m1 = MagicMock(return_value='')
+        subprocess.check_output = m1
+        gc = NamespaceGC(False, kubernetes=KubernetesApiBackend(self.url))
+        self.assertEqual(gc.list_namespaces(), {'4701': ['circleci-4701'], '4702': ['circleci-4702']})
+        results = gc._run_gc_ns_delete_cmd(['circleci-4702', 'forbidden'])
+        self.assertEqual(dict(results), {'circleci-4702': 'deleted', 'forbidden': 'failed'})
+        self.assertFalse(m1.called)
+
+    def test_from_kubeconfig(self):
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        config = {
+            'current-context': 'ci',
+            'contexts': [{'name': 'ci', 'context': {'cluster': 'gke', 'user': 'bot'}}],
+            'clusters': [{'name': 'gke', 'cluster': {
+                'server': 'https://10.0.0.1',
+                'certificate-authority-data': 'Q0EgREFUQQ==',
+            }}],
+            'users': [{'name': 'bot', 'user': {'token': 'k8s-token'}}],
+        }
+        with open(os.path.join(path, 'config'), 'w') as f:
+            yaml.safe_dump(config, f)
+        backend = KubernetesApiBackend.from_kubeconfig(os.path.join(path, 'config'))
+        self.assertEqual(backend.server, 'https://10.0.0.1')
+        self.assertEqual(backend.headers['Authorization'], 'Bearer k8s-token')
+        with open(backend.verify) as f:
+            self.assertEqual(f.read(), 'CA DATA')
+        backend.close()
+        self.assertFalse(os.path.exists(backend.verify))
+
+    def test_from_kubeconfig_auth_provider(self):
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        config = {
+            'current-context': 'gke',
+            'contexts': [{'name': 'gke', 'context': {'cluster': 'gke', 'user': 'gke'}}],
+            'clusters': [{'name': 'gke', 'cluster': {'server': 'https://10.0.0.1'}}],
+            'users': [{'name': 'gke', 'user': {'auth-provider': {'name': 'gcp'}}}],
+        }
+        with open(os.path.join(path, 'config'), 'w') as f:
+            yaml.safe_dump(config, f)
+        with self.assertRaises(KubernetesApiError):
+            KubernetesApiBackend.from_kubeconfig(os.path.join(path, 'config'))
+
+
+class TestKubectlBackend(unittest.TestCase):
+    def test_list_namespaces(self):
+        subprocess.check_output = MagicMock(return_value="""NAME            STATUS        AGE
+circleci-4701   Active        27m
+circleci-4702   Terminating   27m
+default         Active        19d
+""")
+        self.assertEqual(KubectlBackend().list_namespaces(), ['circleci-4701', 'default'])
+
+    def test_delete_namespaces(self):
+        def check_output(cmd, **kwargs):
+            raise subprocess.CalledProcessError(1, cmd, output='\n'.join([
+                'namespace "circleci-4701" deleted',
+                'Error from server (NotFound): namespaces "circleci-4702" not found',
+                'Error from server (Conflict): Operation cannot be fulfilled on namespaces '
+                '"circleci-4703": The system is ensuring all content is removed from this '
+                'namespace.  Upon completion, this namespace will automatically be purged by '
+                'the system.',
+            ]))
+        subprocess.check_output = MagicMock(side_effect=check_output)
+        deleter = KubectlBackend().namespace_deleter()
+        deleter(['circleci-4701', 'circleci-4702', 'circleci-4703'])
+        subprocess.check_output.assert_called_once_with(
+            ['kubectl', 'delete', 'ns', 'circleci-4701', 'circleci-4702', 'circleci-4703'],
+            stderr=subprocess.STDOUT)
+        # a namespace kubectl did not delete fails the call
+        with self.assertRaises(subprocess.CalledProcessError):
+            deleter(['circleci-4701', 'circleci-4704'])
@@ -0,0 +1,63 @@
+import threading
+import time
+import unittest
+
+from circleci.parallel import AsyncClient, parallel_map
+
+
+class TestParallelMap(unittest.TestCase):
+    def test_order(self):
+        self.assertEqual(
+            parallel_map(lambda x: x * 2, [3, 1, 2], concurrency=3),
+            [6, 2, 4]
+        )
+        self.assertEqual(parallel_map(lambda x: x, []), [])
+
+    def test_concurrency_limit(self):
+        lock = threading.Lock()
+        state = {'running': 0, 'max': 0}
+
+        def work(item):
+            with lock:
+                state['running'] += 1
+                state['max'] = max(state['max'], state['running'])
+            time.sleep(0.01)
+            with lock:
+                state['running'] -= 1
+            return item
+
+        self.assertEqual(parallel_map(work, range(10), concurrency=3), list(range(10)))
+        self.assertTrue(1 < state['max'] <= 3)
+
+    def test_exception(self):
+        def work(item):
+            if item == 2:
+                raise ValueError('bad item')
+            return item
+
+        with self.assertRaises(ValueError):
+            parallel_map(work, [1, 2, 3], concurrency=2)
+
+
+class TestAsyncClient(unittest.TestCase):
+    class Client():
+        name = 'client'
+
+        def double(self, x, y=0):
+            return x * 2 + y
+
+        def items(self):
+            for i in range(3):
+                yield i
+
+    def test_methods(self):
+        client = AsyncClient(self.Client())
+        result = client.double(2, y=1)
+        self.assertEqual(result.get(), 5)
+        self.assertEqual(client.items().get(), [0, 1, 2])
+        self.assertEqual(client.name, 'client')
+
+    def test_exception(self):
+        client = AsyncClient(self.Client())
+        with self.assertRaises(TypeError):
+            client.double(None).get()
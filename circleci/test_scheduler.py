@@ -0,0 +1,89 @@
+import time
+import unittest
+import requests
+from mock import MagicMock, patch
+
+from circleci.scheduler import RequestScheduler
+
+
+def response(status_code, headers={}):
+    return MagicMock(status_code=status_code, headers=headers)
+
+
+@patch('time.sleep')
+class TestRequestScheduler(unittest.TestCase):
+    def test_success(self, sleep):
+        func = MagicMock(return_value=response(200))
+        resp = RequestScheduler().send('token', 'get', func, 'url', headers={})
+        self.assertEqual(resp.status_code, 200)
+        func.assert_called_once_with('url', headers={})
+        self.assertFalse(sleep.called)
+
+    def test_retry_server_error(self, sleep):
+        func = MagicMock(side_effect=[response(502), response(503), response(200)])
+        resp = RequestScheduler(backoff=1, max_backoff=60).send('token', 'get', func, 'url')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(func.call_count, 3)
+        delays = [c[0][0] for c in sleep.call_args_list]
+        self.assertTrue(0.5 <= delays[0] <= 1)
+        self.assertTrue(1 <= delays[1] <= 2)
+
+    def test_no_retry_server_error_on_post(self, sleep):
+        func = MagicMock(return_value=response(500))
+        resp = RequestScheduler().send('token', 'post', func, 'url')
+        self.assertEqual(resp.status_code, 500)
+        self.assertEqual(func.call_count, 1)
+
+    def test_retry_after(self, sleep):
+        func = MagicMock(side_effect=[response(429, {'Retry-After': '7'}), response(201)])
+        resp = RequestScheduler().send('token', 'post', func, 'url')
+        self.assertEqual(resp.status_code, 201)
+        sleep.assert_called_once_with(7.0)
+
+    def test_rate_limit_exhausted(self, sleep):
+        reset = str(int(time.time()) + 30)
+        func = MagicMock(side_effect=[
+            response(403, {'X-RateLimit-Remaining': '0', 'X-RateLimit-Reset': reset}),
+            response(200),
+        ])
+        RequestScheduler().send('token', 'get', func, 'url')
+        delay = sleep.call_args_list[-1][0][0]
+        self.assertTrue(25 < delay <= 31)
+
+    def test_forbidden_is_not_retried(self, sleep):
+        func = MagicMock(return_value=response(403, {'X-RateLimit-Remaining': '4000'}))
+        self.assertEqual(RequestScheduler().send('token', 'get', func, 'url').status_code, 403)
+        self.assertEqual(func.call_count, 1)
+
+    def test_max_retries(self, sleep):
+        func = MagicMock(return_value=response(503))
+        resp = RequestScheduler(max_retries=2).send('token', 'get', func, 'url')
+        self.assertEqual(resp.status_code, 503)
+        self.assertEqual(func.call_count, 3)
+
+    def test_connection_error(self, sleep):
+        func = MagicMock(side_effect=[requests.ConnectionError('reset'), response(200)])
+        self.assertEqual(RequestScheduler().send('token', 'get', func, 'url').status_code, 200)
+
+        func = MagicMock(side_effect=requests.ConnectionError('reset'))
+        with self.assertRaises(requests.ConnectionError):
+            RequestScheduler().send('token', 'post', func, 'url')
+
+    def test_pace(self, sleep):
+        reset = str(int(time.time()) + 100)
+        scheduler = RequestScheduler(reserve=10)
+        func = MagicMock(return_value=response(200, {'X-RateLimit-Remaining': '500', 'X-RateLimit-Reset': reset}))
+        scheduler.send('token', 'get', func, 'url')
+        scheduler.send('token', 'get', func, 'url')
+        self.assertFalse(sleep.called)
+
+        func.return_value = response(200, {'X-RateLimit-Remaining': '5', 'X-RateLimit-Reset': reset})
+        scheduler.send('token', 'get', func, 'url')
+        scheduler.send('token', 'get', func, 'url')
+        delay = sleep.call_args[0][0]
+        self.assertTrue(15 < delay <= 20)
+
+        # quota is tracked per token
+        sleep.reset_mock()
+        scheduler.send('other', 'get', func, 'url')
+        self.assertFalse(sleep.called)
@@ -0,0 +1,36 @@
+import os
+import unittest
+
+import circleci.session
+from circleci.base import CircleCIBase
+from circleci.github import Github
+
+
+class TestSession(unittest.TestCase):
+    def setUp(self):
+        os.environ['CIRCLE_TOKEN'] = 'CI_TOKEN'
+        os.environ['GH_OAUTH_TOKEN'] = 'GH_TOKEN'
+        circleci.session.reset_session()
+
+    def test_create_session(self):
+        session = circleci.session.create_session(
+            pool_connections=2, pool_maxsize=5, pool_block=True)
+        adapter = session.get_adapter('https://api.github.com')
+        self.assertEqual(adapter._pool_connections, 2)
+        self.assertEqual(adapter._pool_maxsize, 5)
+        self.assertEqual(adapter._pool_block, True)
+        self.assertTrue(session.get_adapter('http://example.com') is adapter)
+        self.assertEqual(session.headers['Connection'], 'keep-alive')
+
+    def test_create_session_without_keep_alive(self):
+        session = circleci.session.create_session(keep_alive=False)
+        self.assertEqual(session.headers['Connection'], 'close')
+
+    def test_shared_session(self):
+        self.assertTrue(CircleCIBase().session is Github().session)
+        self.assertTrue(Github().session is circleci.session.get_session())
+
+    def test_reset_session(self):
+        session = circleci.session.get_session()
+        circleci.session.reset_session()
+        self.assertFalse(session is circleci.session.get_session())
@@ -0,0 +1,46 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from circleci.state import GCStateStore
+
+
+class TestGCStateStore(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.db = os.path.join(self.path, 'gc.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_reconcile(self):
+        store = GCStateStore(self.db)
+        store.reconcile('namespace', {'4701': ['circleci-4701'], '4702': ['circleci-4702']}, now=100)
+        self.assertEqual(store.get('namespace', 'circleci-4701')['first_seen'], 100)
+        self.assertEqual(store.get('vm', 'circleci-4701'), None)
+
+        store.reconcile('namespace', {'4701': ['circleci-4701']}, now=200)
+        row = store.get('namespace', 'circleci-4701')
+        self.assertEqual((row['build_num'], row['first_seen'], row['last_seen']), ('4701', 100, 200))
+        self.assertEqual(store.get('namespace', 'circleci-4702'), None)
+
+    def test_pending(self):
+        store = GCStateStore(self.db, retry_after=60)
+        store.reconcile('namespace', {'4701': ['circleci-4701'], '4702': ['circleci-4702']}, now=100)
+        store.record_deletions('namespace', {
+            'circleci-4701': 'deleted',
+            'circleci-4702': 'failed',
+            'circleci-4703': 'noop',
+        }, now=100)
+        self.assertEqual(store.pending('namespace', now=120), set(['circleci-4701']))
+        self.assertEqual(store.pending('vm', now=120), set())
+        # stuck deletions are requested again once retry_after has passed
+        self.assertEqual(store.pending('namespace', now=200), set())
+        self.assertEqual(store.get('namespace', 'circleci-4703'), None)
+
+    def test_persistence(self):
+        store = GCStateStore(self.db)
+        store.record_deletions('vm', {'condor-circleci-4701': 'deleted'})
+        store.close()
+        self.assertEqual(GCStateStore(self.db).pending('vm'), set(['condor-circleci-4701']))
@@ -1,4 +1,17 @@
+import gzip
+import json
+import os
+import shutil
+import tempfile
 import unittest
+import yaml
+from collections import OrderedDict
+from mock import patch
+
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
 
 import circleci.utils
 
@@ -7,6 +20,60 @@ class TestUtils(unittest.TestCase):
         custom_values = circleci.utils.digests_to_custom_values('circleci/fixtures/test-values.yaml',
                                                                 'circleci/fixtures/image-versions.log')
         self.assertEqual(
-            custom_values,
-            '{ "mongo": {"repo": "mongo@sha256","tag": "fa24030aec1989c1df5440562282891b95a92e00e28ed05332e8f0270efe34d1"},"mysql": {"repo": "mysql@sha256","tag": "967a8020398f76f99ba74144e6e661f46003c685192b83d7bb87d026562319ae"} }'
+            list(custom_values.items()),
+            [
+                ('mongo', {'repo': 'mongo@sha256', 'tag': 'fa24030aec1989c1df5440562282891b95a92e00e28ed05332e8f0270efe34d1'}),
+                ('mysql', {'repo': 'mysql@sha256', 'tag': '967a8020398f76f99ba74144e6e661f46003c685192b83d7bb87d026562319ae'}),
+            ]
+        )
+
+    def test_digests_to_custom_values_gzip(self):
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        digests = os.path.join(path, 'image-versions.log.gz')
+        with open('circleci/fixtures/image-versions.log', 'rb') as src:
+            with gzip.open(digests, 'wb') as dst:
+                dst.write(src.read())
+        self.assertEqual(
+            circleci.utils.digests_to_custom_values('circleci/fixtures/test-values.yaml', digests),
+            circleci.utils.digests_to_custom_values('circleci/fixtures/test-values.yaml',
+                                                    'circleci/fixtures/image-versions.log')
+        )
+
+    def test_digests_to_custom_values_stdin(self):
+        with open('circleci/fixtures/image-versions.log') as f:
+            with patch('sys.stdin', f):
+                custom_values = circleci.utils.digests_to_custom_values(
+                    'circleci/fixtures/test-values.yaml', '-')
+        self.assertEqual(custom_values['mysql']['repo'], 'mysql@sha256')
+
+    def test_match_digest(self):
+        charts = circleci.utils.chart_index({
+            'mysql': {'tag': 'latest', 'repo': 'project/mysql'},
+            'sql': {'tag': 'latest', 'repo': 'sql'},
+            'web': {'tag': 'latest', 'repo': 'web'},
+            'worker': {'tag': 'latest', 'repo': 'web'},
+            'config': {'repo': 'config'},
+        })
+        line = 'Image ID:\t\tdocker-pullable://gcr.io/project/mysql@sha256:abc123\n'
+        self.assertEqual(circleci.utils.match_digest(line, charts), [('mysql', 'project/mysql', 'abc123')])
+        line = 'Image ID:\t\tdocker-pullable://web@sha256:def456\n'
+        self.assertEqual(
+            sorted(circleci.utils.match_digest(line, charts)),
+            [('web', 'web', 'def456'), ('worker', 'web', 'def456')]
         )
+        self.assertEqual(circleci.utils.match_digest('Image:\t\tconfig:latest\n', charts), [])
+
+    def test_write_custom_values(self):
+        custom_values = OrderedDict([
+            ('mongo', {'repo': 'mongo@sha256', 'tag': 'fa24'}),
+            ('my"sql', {'repo': 'my"sql@sha256', 'tag': '967a'}),
+        ])
+        stream = StringIO()
+        circleci.utils.write_custom_values(custom_values, stream)
+        self.assertEqual(json.loads(stream.getvalue()), custom_values)
+        self.assertTrue(stream.getvalue().startswith('{"mongo"'))
+
+        stream = StringIO()
+        circleci.utils.write_custom_values(custom_values, stream, format='yaml')
+        self.assertEqual(yaml.safe_load(stream.getvalue()), dict(custom_values))
@@ -1,6 +1,13 @@
-import re
 import argparse
+import codecs
+import contextlib
+import gzip
+import json
+import sys
 import yaml
+from collections import OrderedDict
+
+GZIP_MAGIC = b'\x1f\x8b'
 
 def digests_to_custom_values(values, digests):
     '''
@@ -18,38 +25,112 @@ def digests_to_custom_values(values, digests):
 
     Image ID:		docker-pullable://mongo@sha256:fa24030aec1989c1df5440562282891b95a92e00e28ed05332e8f0270efe34d1
     Image ID:		docker-pullable://mysql@sha256:967a8020398f76f99ba74144e6e661f46003c685192b83d7bb87d026562319ae
+
+    Returns:
+    (OrderedDict): chart to its repo and digest tag, in the order found
     '''
     with open(values, "r") as stream:
         try:
             values = yaml.load(stream)
         except yaml.YAMLError as exc:
             print(exc)
-    #search only for a list of charts with configurable tags
-    charts = []
+    charts = chart_index(values)
+
+    custom_values = OrderedDict()
+    with open_digests(digests) as image_versions:
+        for line in image_versions:
+            for chart, repo, digest in match_digest(line, charts):
+                custom_values[chart] = {
+                    'repo': '{}@sha256'.format(repo),
+                    'tag': digest,
+                }
+    return custom_values
+
+
+def write_custom_values(custom_values, stream, format='json'):
+    '''
+    Writes custom values as json, for the integration CUSTOM_VALUES build
+    parameter, or as yaml, usable as a helm --values file.
+    '''
+    if format == 'yaml':
+        yaml.safe_dump(dict(custom_values), stream, default_flow_style=False)
+    else:
+        json.dump(custom_values, stream)
+        stream.write('\n')
+
+
+def chart_index(values):
+    '''
+    Maps each image repo to the charts with configurable tags using it.
+    '''
+    charts = {}
     for chart in values:
         if type(values[chart]) is dict:
             if values[chart].get("tag"):
-                charts.append(chart)
+                charts.setdefault(values[chart]["repo"], []).append(chart)
+    return charts
 
-    custom_values = []
-    with open(digests, "r") as image_versions:
-        for line in image_versions:
-            for chart in charts:
-                if re.search('/{}@'.format(values[chart]["repo"]), line):
-                    custom_values.append('"{}": {{"repo": "{}@sha256","tag": "{}"}}'.format(
-                        chart,
-                        values[chart]["repo"],
-                        line.split(":")[3].strip()
-                    ))
-    return "{{ {} }}".format(",".join(custom_values))
+
+def match_digest(line, charts):
+    '''
+    Finds the image digest on a line of the digests file. The image matches
+    a repo when the repo is a suffix of the image name starting after a /,
+    e.g. docker-pullable://gcr.io/project/mysql matches project/mysql and
+    mysql.
+
+    Returns:
+    (list): (chart, repo, digest) tuples
+    '''
+    image, sep, digest = line.partition('@sha256:')
+    if not sep:
+        return []
+    image = image.split()[-1] if image.split() else ''
+    digest = digest.split()[0] if digest.split() else ''
+    matches = []
+    slash = image.find('/')
+    while slash != -1:
+        repo = image[slash + 1:]
+        for chart in charts.get(repo, []):
+            matches.append((chart, repo, digest))
+        slash = image.find('/', slash + 1)
+    return matches
+
+
+def open_digests(digests):
+    '''
+    Opens the digests file, - reads stdin and gzipped files are
+    decompressed on the fly.
+    '''
+    if digests == '-':
+        return _stdin()
+    with open(digests, "rb") as f:
+        gzipped = f.read(2) == GZIP_MAGIC
+    if gzipped:
+        # text mode so lines are strings like those of a plain file
+        return codecs.getreader('utf-8')(gzip.open(digests, "rb"))
+    return open(digests, "r")
+
+
+@contextlib.contextmanager
+def _stdin():
+    yield sys.stdin
 
 
 def arg_parser():
     p = argparse.ArgumentParser()
     p.add_argument('values', type=str, help='helm values file')
-    p.add_argument("digests", type=str, help="file containing docker digests")
+    p.add_argument("digests", type=str, help="file containing docker digests, - for stdin, may be gzipped")
+    p.add_argument('--format', choices=['json', 'yaml'], default='json',
+                   help='output format')
+    p.add_argument('--values-file', type=str, default=None,
+                   help='write a helm --values file instead of printing')
     return p.parse_args()
 
 def digests_to_custom_values_cli():
     args = arg_parser()
-    print digests_to_custom_values(args.values, args.digests)
+    custom_values = digests_to_custom_values(args.values, args.digests)
+    if args.values_file is not None:
+        with open(args.values_file, 'w') as f:
+            write_custom_values(custom_values, f, format='yaml')
+    else:
+        write_custom_values(custom_values, sys.stdout, format=args.format)